@@ -1,46 +1,70 @@
-import os
+import threading
 import streamlit as st
+import admin_data
 import database
+import question_sets
 import asyncio
-from dotenv import load_dotenv
 
-load_dotenv()
-GROUPS = [int(x) for x in os.getenv("GROUPS", "").split(",") if x]
-SUPER_ADMINS = [int(x) for x in os.getenv("SUPER_ADMINS", "").split(",") if x]
 
+# Один фоновый event loop на процесс: пул соединений database.py живёт в нём
+# между перезапусками скрипта, а не создаётся заново на каждый запрос.
+@st.cache_resource
+def get_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(database.init(), loop).result()
+    return loop
 
-def run_async(coro):
-    return asyncio.run(coro)
 
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
 
-@st.cache_resource
-def init_db():
-    run_async(database.init())
 
+def mutate(coro):
+    result = run_async(coro)
+    admin_data.invalidate()
+    return result
 
-init_db()
 
+get_loop()
 st.sidebar.title("MSR Admin")
 
-groups = run_async(database.get_groups_info())
+groups = admin_data.load_groups()
 group_dict = {title: cid for cid, title in groups}
+
+# Обычно группа подключается сама, когда бота делают в ней админом; здесь —
+# вручную по chat_id (например, если бот уже был админом раньше)
+with st.sidebar.expander("Подключить группу", expanded=not group_dict):
+    new_chat_id = st.number_input("chat_id группы", value=0, step=1, format="%d")
+    new_title = st.text_input("Название")
+    if st.button("Подключить", key="register_group") and new_chat_id:
+        mutate(database.register_group(int(new_chat_id), new_title or None))
+        st.rerun()
+
 if not group_dict:
-    group_dict = {str(cid): cid for cid in GROUPS}
+    st.info("Нет подключённых групп. Сделайте бота админом в группе или подключите её вручную.")
+    st.stop()
 
 selected_title = st.sidebar.selectbox("Группа", list(group_dict.keys()))
 chat_id = group_dict[selected_title]
+if st.sidebar.button("Отключить группу", key="unregister_group"):
+    mutate(database.unregister_group(chat_id))
+    st.rerun()
+data = admin_data.load_group(chat_id)
 
-tab1, tab2, tab3, tab4, tab5 = st.tabs(["Вопросы", "Добавить", "Попытки", "Админы", "Статистика"])
+tab1, tab2, tab3, tab4, tab5, tab_analytics, tab6 = st.tabs(
+    ["Вопросы", "Добавить", "Попытки", "Админы", "Статистика", "Аналитика", "Метрики"]
+)
 
 with tab1:
     st.header("Вопросы")
-    questions = run_async(database.get_questions(chat_id))
+    questions = data["questions"]
     if questions:
         for qid, q, a in questions:
             col1, col2 = st.columns([4, 1])
             col1.write(f"{q} → {a}")
             if col2.button("🗑", key=f"del_{qid}"):
-                run_async(database.delete_question(qid))
+                mutate(database.delete_question(qid))
                 st.experimental_rerun()
     else:
         st.info("Нет вопросов")
@@ -48,22 +72,58 @@ with tab1:
 with tab2:
     st.header("Добавить вопрос")
     question = st.text_input("Вопрос")
-    answer = st.text_input("Ответ")
+    answer = st.text_input("Ответ", help="Несколько верных ответов — через |, например: Москва|Moscow")
     if st.button("Добавить", key="add_question"):
-        run_async(database.add_question(chat_id, question, answer))
+        mutate(database.add_question(chat_id, question, answer))
         st.success("Добавлено!")
 
+    st.header("Импорт")
+    uploaded = st.file_uploader("CSV (вопрос,ответ) или JSON", type=["csv", "json", "txt"])
+    replace = st.checkbox("Заменить текущие вопросы", key="import_replace")
+    if uploaded is not None and st.button("Импортировать", key="import_questions"):
+        try:
+            pairs = question_sets.parse(uploaded.getvalue(), uploaded.name)
+        except ValueError as e:
+            st.error(f"Файл не импортирован:\n{e}")
+        else:
+            mutate(database.import_questions([chat_id], pairs, replace=replace))
+            st.success(f"Импортировано вопросов: {len(pairs)}")
+
+    st.header("Экспорт")
+    pairs = [(q, a) for _, q, a in data["questions"]]
+    col1, col2 = st.columns(2)
+    col1.download_button("CSV", question_sets.to_csv(pairs), f"questions_{chat_id}.csv", "text/csv")
+    col2.download_button("JSON", question_sets.to_json(pairs), f"questions_{chat_id}.json", "application/json")
+
+    st.header("Копировать в другие группы")
+    others = {title: cid for title, cid in group_dict.items() if cid != chat_id}
+    targets = st.multiselect("Группы", list(others))
+    copy_replace = st.checkbox("Заменить их вопросы", key="copy_replace")
+    if targets and st.button("Копировать", key="copy_questions"):
+        n = mutate(database.copy_questions(chat_id, [others[t] for t in targets], replace=copy_replace))
+        st.success(f"Скопировано вопросов: {n}")
+
 with tab3:
     st.header("Попытки")
-    current = run_async(database.get_max_attempts(chat_id))
+    current = data["max_attempts"]
     new_val = st.number_input("Количество попыток", min_value=1, max_value=10, value=current)
     if st.button("Сохранить", key="save_attempts"):
-        run_async(database.set_max_attempts(chat_id, new_val))
+        mutate(database.set_max_attempts(chat_id, new_val))
+        st.success("Сохранено!")
+
+    st.header("Срок проверки")
+    minutes = st.number_input(
+        "Выгонять не прошедших проверку через, минут (0 — никогда)",
+        min_value=0,
+        value=data["verify_timeout"] // 60,
+    )
+    if st.button("Сохранить", key="save_timeout"):
+        mutate(database.set_verify_timeout(chat_id, minutes * 60))
         st.success("Сохранено!")
 
 with tab4:
     st.header("Админы группы")
-    admins = run_async(database.get_group_admins(chat_id))
+    admins = data["admins"]
     if admins:
         st.write("Текущие админы:")
         for uid in admins:
@@ -73,12 +133,13 @@ with tab4:
 
     new_admin = st.number_input("ID нового админа", min_value=1, step=1)
     if st.button("Добавить", key="add_admin"):
-        run_async(database.add_admin(chat_id, new_admin))
+        mutate(database.add_admin(chat_id, new_admin))
         st.success("Добавлен!")
 
 with tab5:
     st.header("Статистика")
-    total, ok, bad, rows = run_async(database.get_stats(chat_id))
+    total, ok, bad = data["stats"]
+    rows = data["last"]
     st.metric("Всего", total)
     st.metric("Правильно", ok)
     st.metric("Неправильно", bad)
@@ -88,5 +149,78 @@ with tab5:
             mark = "✅" if ok_flag else "❌"
             st.text(f"{mark} {un}: {q} → {ans}")
 
+    archived = data["archived"]
+    if archived:
+        st.subheader("В архиве (учтено во «Всего»):")
+        for month, a_total, a_ok, a_bad in archived:
+            st.text(f"{month}: всего {a_total}, ✅ {a_ok}, ❌ {a_bad}")
+
+    st.subheader("Хранение лога")
+    days, max_rows = data["retention"]
+    new_days = st.number_input("Хранить дней (0 — без ограничения)", min_value=0, value=days)
+    new_rows = st.number_input("Хранить строк (0 — без ограничения)", min_value=0, value=max_rows, step=1000)
+    if st.button("Сохранить", key="save_retention"):
+        mutate(database.set_log_retention(chat_id, new_days, new_rows))
+        st.success("Сохранено!")
+
+with tab_analytics:
+    st.header("По вопросам")
+    answer_stats = admin_data.load_answer_stats(chat_id)
+    if answer_stats.empty:
+        st.info("Ответов пока нет")
+    else:
+        per_question = admin_data.by_question(answer_stats)
+        st.dataframe(
+            per_question.rename(
+                columns={"total": "ответов", "correct": "верно", "wrong": "неверно", "pass_rate": "доля верных"}
+            ),
+            use_container_width=True,
+        )
+        picked = st.selectbox("Частые неверные ответы на вопрос", list(per_question.index))
+        if picked:
+            st.dataframe(admin_data.load_wrong_answers(chat_id, picked).rename("раз"), use_container_width=True)
+
+        st.header("По времени")
+        period = st.radio("Шаг", list(admin_data.PERIODS), horizontal=True)
+        per_period = admin_data.by_period(answer_stats, period)
+        st.line_chart(per_period["pass_rate"].rename("доля верных"))
+        st.bar_chart(per_period[["correct", "wrong"]].rename(columns={"correct": "верно", "wrong": "неверно"}))
+
+    st.header("Время прохождения проверки")
+    hist, median = admin_data.load_verify_times(chat_id)
+    if median is None:
+        st.info("Нет данных: время записывается для вступивших после обновления бота")
+    else:
+        st.caption(f"Медиана: {median}")
+        st.bar_chart(hist)
+
+    st.header("Баны по группам")
+    outcomes = admin_data.load_outcomes()
+    st.dataframe(
+        outcomes.rename(
+            columns={
+                "verified": "прошли",
+                "banned": "забанены",
+                "not_verified": "ждут",
+                "ban_rate": "доля банов",
+            }
+        ),
+        use_container_width=True,
+    )
+
+with tab6:
+    st.header("Метрики бота")
+    bot_metrics = admin_data.load_bot_metrics()
+    if bot_metrics is None:
+        st.info("Бот не отвечает на /metrics (не запущен или METRICS_PORT=0).")
+    else:
+        st.dataframe(
+            [
+                {"метрика": name, "что": label, "вызовов": count, "среднее, мс": round(avg, 2)}
+                for name, label, count, avg in bot_metrics
+            ],
+            use_container_width=True,
+        )
+
 st.sidebar.markdown("---")
 st.sidebar.caption("Создано на Streamlit")
\ No newline at end of file
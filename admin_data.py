@@ -0,0 +1,228 @@
+import json
+import re
+import sqlite3
+import threading
+import urllib.request
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import database
+from config import (
+    ADMIN_DATA_TTL,
+    DB_BUSY_TIMEOUT_MS,
+    DEFAULT_ATTEMPTS,
+    LOG_MAX_ROWS,
+    LOG_RETENTION_DAYS,
+    METRICS_HOST,
+    METRICS_PORT,
+    VERIFY_TIMEOUT_SEC,
+)
+
+# Всё, что админке нужно показать по группе, одним запросом: вложенные
+# выборки собираются в JSON прямо в SQLite.
+GROUP_SQL = """
+SELECT
+    (SELECT json_array(max_attempts, log_retention_days, log_max_rows, verify_timeout_sec)
+       FROM groups WHERE chat_id = :chat_id),
+    (SELECT json_group_array(json_array(id, question, answer))
+       FROM (SELECT id, question, answer FROM questions WHERE chat_id = :chat_id ORDER BY id)),
+    (SELECT json_group_array(user_id) FROM group_admins WHERE chat_id = :chat_id),
+    (SELECT json_array(COALESCE(SUM(total), 0), COALESCE(SUM(correct), 0), COALESCE(SUM(wrong), 0))
+       FROM answer_stats WHERE chat_id = :chat_id),
+    (SELECT json_group_array(json_array(username, question, given_answer, is_correct))
+       FROM (SELECT username, question, given_answer, is_correct FROM answers_log
+             WHERE chat_id = :chat_id ORDER BY id DESC LIMIT 10)),
+    (SELECT json_group_array(json_array(month, total, correct, wrong))
+       FROM (SELECT substr(day, 1, 7) AS month, SUM(total) AS total,
+                    SUM(correct) AS correct, SUM(wrong) AS wrong
+             FROM archived_stats WHERE chat_id = :chat_id GROUP BY month ORDER BY month))
+"""
+
+
+# ---------- чтение для админки ----------
+# Синхронное соединение только для чтения, одно на процесс Streamlit.
+# Сессии работают в разных потоках, поэтому запросы идут под замком.
+@st.cache_resource
+def _connection():
+    conn = sqlite3.connect(database.DB, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA query_only=ON")
+    return conn, threading.Lock()
+
+
+def _query(sql: str, params=()):
+    conn, lock = _connection()
+    with lock:
+        return conn.execute(sql, params).fetchall()
+
+
+def load_groups():
+    # Список групп меняет и бот (когда его делают админом), поэтому кэш
+    # привязан к счётчику counters.groups: новая группа видна сразу, без
+    # ожидания ADMIN_DATA_TTL.
+    row = _query("SELECT value FROM counters WHERE name='groups'")
+    return _load_groups(row[0][0] if row else 0)
+
+
+@st.cache_data(ttl=ADMIN_DATA_TTL)
+def _load_groups(version: int):
+    return _query("SELECT chat_id, title FROM groups WHERE enabled=1 ORDER BY chat_id")
+
+
+@st.cache_data(ttl=ADMIN_DATA_TTL)
+def load_group(chat_id: int):
+    settings, questions, admins, totals, last, archived = _query(GROUP_SQL, {"chat_id": chat_id})[0]
+    max_attempts, days, max_rows, timeout = json.loads(settings) if settings else (None,) * 4
+    return {
+        "max_attempts": DEFAULT_ATTEMPTS if max_attempts is None else max_attempts,
+        "verify_timeout": VERIFY_TIMEOUT_SEC if timeout is None else timeout,
+        "retention": (
+            LOG_RETENTION_DAYS if days is None else days,
+            LOG_MAX_ROWS if max_rows is None else max_rows,
+        ),
+        "questions": json.loads(questions),
+        "admins": json.loads(admins),
+        "stats": json.loads(totals),
+        "last": json.loads(last),
+        "archived": json.loads(archived),
+    }
+
+
+# ---------- метрики бота ----------
+SERIES_RE = re.compile(r'^(msr_\w+?)_(sum|count)\{\w+="([^"]*)"\} (\S+)$')
+
+
+@st.cache_data(ttl=5)
+def load_bot_metrics():
+    # [(метрика, метка, вызовов, среднее мс)] с /metrics бота или None,
+    # если бот не запущен или метрики выключены
+    if not METRICS_PORT:
+        return None
+    try:
+        with urllib.request.urlopen(f"http://{METRICS_HOST}:{METRICS_PORT}/metrics", timeout=2) as resp:
+            text = resp.read().decode()
+    except OSError:
+        return None
+    series: dict[tuple[str, str], dict[str, float]] = {}
+    for line in text.splitlines():
+        m = SERIES_RE.match(line)
+        if m:
+            name, kind, label, value = m.groups()
+            series.setdefault((name, label), {})[kind] = float(value)
+    return [
+        (name, label, int(v.get("count", 0)), v.get("sum", 0) / v["count"] * 1000 if v.get("count") else 0.0)
+        for (name, label), v in sorted(series.items())
+    ]
+
+
+# ---------- аналитика ----------
+# Ответы считаются по сводке answer_stats (строка на группу, день и вопрос,
+# поэтому она маленькая при любом размере лога), а то, чего в сводке нет,
+# читается из базы кусками по CHUNK строк и сворачивается pandas/NumPy,
+# так что память не зависит от размера answers_log и user_group_state.
+CHUNK = 100_000
+# границы корзин времени прохождения проверки, секунды
+VERIFY_BINS = np.array([0, 15, 30, 60, 120, 300, 600, 1800, 3600, 6 * 3600, 86400, np.inf])
+VERIFY_LABELS = ["<15 с", "15–30 с", "30–60 с", "1–2 мин", "2–5 мин", "5–10 мин",
+                 "10–30 мин", "30–60 мин", "1–6 ч", "6–24 ч", ">24 ч"]
+PERIODS = {"день": "D", "неделя": "W", "месяц": "MS"}
+
+
+def _chunks(sql: str, params=()):
+    # Замок берётся на каждую пачку отдельно: пока одна сессия проходит по
+    # длинному логу, запросы других сессий выполняются между её пачками.
+    conn, lock = _connection()
+    with lock:
+        cur = conn.execute(sql, params)
+        columns = [d[0] for d in cur.description]
+    while True:
+        with lock:
+            rows = cur.fetchmany(CHUNK)
+        if not rows:
+            return
+        yield pd.DataFrame.from_records(rows, columns=columns)
+
+
+@st.cache_data(ttl=ADMIN_DATA_TTL)
+def load_answer_stats(chat_id: int) -> pd.DataFrame:
+    conn, lock = _connection()
+    with lock:
+        df = pd.read_sql_query(
+            "SELECT day, question, total, correct, wrong FROM answer_stats WHERE chat_id=?",
+            conn,
+            params=(chat_id,),
+        )
+    df["day"] = pd.to_datetime(df["day"])
+    return df
+
+
+def _with_rate(df: pd.DataFrame) -> pd.DataFrame:
+    df["pass_rate"] = (df["correct"] / df["total"].where(df["total"] > 0)).round(3)
+    return df
+
+
+def by_question(stats: pd.DataFrame) -> pd.DataFrame:
+    df = stats.groupby("question")[["total", "correct", "wrong"]].sum()
+    return _with_rate(df).sort_values("pass_rate")
+
+
+def by_period(stats: pd.DataFrame, period: str) -> pd.DataFrame:
+    df = stats.groupby(pd.Grouper(key="day", freq=PERIODS[period]))[["total", "correct", "wrong"]].sum()
+    return _with_rate(df[df["total"] > 0])
+
+
+@st.cache_data(ttl=ADMIN_DATA_TTL)
+def load_verify_times(chat_id: int):
+    # (гистограмма по VERIFY_LABELS, корзина с медианой или None)
+    counts = np.zeros(len(VERIFY_LABELS), dtype=np.int64)
+    for chunk in _chunks(
+        "SELECT finished_at - joined_at AS sec FROM user_group_state "
+        "WHERE chat_id=? AND status='verified' AND joined_at IS NOT NULL AND finished_at IS NOT NULL",
+        (chat_id,),
+    ):
+        counts += np.histogram(chunk["sec"].to_numpy(), VERIFY_BINS)[0]
+    hist = pd.Series(counts, index=VERIFY_LABELS, name="пользователей")
+    if not counts.sum():
+        return hist, None
+    # медиана по гистограмме: корзина, в которой набралась половина
+    return hist, VERIFY_LABELS[int(np.searchsorted(np.cumsum(counts), counts.sum() / 2))]
+
+
+@st.cache_data(ttl=ADMIN_DATA_TTL)
+def load_outcomes() -> pd.DataFrame:
+    # сколько прошли, забанены и ждут проверки по всем группам
+    conn, lock = _connection()
+    with lock:
+        df = pd.read_sql_query(
+            "SELECT s.chat_id, COALESCE(g.title, s.chat_id) AS title, s.status, COUNT(*) AS n "
+            "FROM user_group_state s LEFT JOIN groups g ON g.chat_id = s.chat_id "
+            "GROUP BY s.chat_id, s.status",
+            conn,
+        )
+    table = df.pivot_table(index="title", columns="status", values="n", aggfunc="sum", fill_value=0)
+    table = table.reindex(columns=["verified", "banned", "not_verified"], fill_value=0)
+    finished = table["verified"] + table["banned"]
+    table["ban_rate"] = (table["banned"] / finished.where(finished > 0)).round(3)
+    return table.sort_values("ban_rate", ascending=False)
+
+
+@st.cache_data(ttl=ADMIN_DATA_TTL)
+def load_wrong_answers(chat_id: int, question: str, top: int = 20) -> pd.Series:
+    # самые частые неверные ответы на вопрос, по всему логу группы; читается
+    # только частичный индекс idx_answers_log_wrong, а не весь лог
+    counts = pd.Series(dtype=np.int64)
+    for chunk in _chunks(
+        "SELECT given_answer FROM answers_log WHERE chat_id=? AND question=? AND is_correct=0",
+        (chat_id, question),
+    ):
+        given = chunk["given_answer"].fillna("").str.strip().str.lower()
+        counts = counts.add(given.value_counts(), fill_value=0)
+    return counts.sort_values(ascending=False).head(top).astype(np.int64)
+
+
+def invalidate():
+    # после любой правки из админки
+    _load_groups.clear()
+    load_group.clear()
@@ -0,0 +1,382 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Бенчмарк гоняет настоящий dp из bot.py на синтетических обновлениях.
+# Telegram заменён FakeSession, база — временным файлом, поэтому начальный
+# список групп и токен задаются до импорта bot.py.
+MAX_GROUPS = 50
+GROUP_IDS = [-1001000000000 - i for i in range(MAX_GROUPS)]
+os.environ["BOT_TOKEN"] = "123456:bench"
+os.environ["GROUPS"] = ",".join(map(str, GROUP_IDS))
+os.environ["METRICS_PORT"] = "0"
+
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.methods import GetMe, SendMessage, TelegramMethod  # noqa: E402
+from aiogram.types import Chat, Message, Update, User  # noqa: E402
+
+import bot  # noqa: E402
+import database  # noqa: E402
+import metrics  # noqa: E402
+
+ANSWER = "42"
+
+
+# ---------- поддельный Telegram ----------
+class FakeSession(BaseSession):
+    # Не ходит в сеть: запоминает каждый вызов Bot API и отвечает после
+    # искусственной задержки latency секунд.
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: list[str] = []
+        self.texts: list[str] = []
+        self._message_id = 0
+
+    async def make_request(self, bot, method: TelegramMethod, timeout=None):
+        self.calls.append(type(method).__name__)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, GetMe):
+            return User(id=123456, is_bot=True, first_name="Bench", username="bench_bot")
+        if isinstance(method, SendMessage):
+            self.texts.append(method.text)
+            self._message_id += 1
+            return Message(
+                message_id=self._message_id,
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type="supergroup"),
+                text=method.text,
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+# ---------- синтетические обновления ----------
+class Updates:
+    def __init__(self):
+        self._id = 0
+
+    def _next(self) -> int:
+        self._id += 1
+        return self._id
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def join(self, chat_id: int, user_id: int) -> Update:
+        user = self._user(user_id)
+        return Update.model_validate(
+            {
+                "update_id": self._next(),
+                "chat_member": {
+                    "chat": {"id": chat_id, "type": "supergroup", "title": f"Group {chat_id}"},
+                    "from": user,
+                    "date": int(time.time()),
+                    "old_chat_member": {"status": "left", "user": user},
+                    "new_chat_member": {"status": "member", "user": user},
+                },
+            },
+            context={"bot": bot.bot},
+        )
+
+    def private(self, user_id: int, text: str) -> Update:
+        return Update.model_validate(
+            {
+                "update_id": self._next(),
+                "message": {
+                    "message_id": self._next(),
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": self._user(user_id),
+                    "text": text,
+                },
+            },
+            context={"bot": bot.bot},
+        )
+
+
+# ---------- прогон ----------
+class Run:
+    def __init__(self, session: FakeSession):
+        self.session = session
+        self.latencies: list[float] = []
+        self.updates = 0
+        self.queries = 0
+        self.measuring = False
+
+    def on_query(self, sql: str):
+        # подготовка данных сценария в счёт не идёт
+        if self.measuring:
+            self.queries += 1
+
+    async def _feed(self, update: Update):
+        started = time.perf_counter()
+        await bot.dp.feed_update(bot.bot, update)
+        self.latencies.append(time.perf_counter() - started)
+
+    async def phase(self, updates: list[Update], rate: float):
+        # обновления приходят с темпом rate в секунду и обрабатываются
+        # параллельно, как при polling с handle_as_tasks
+        self.measuring = True
+        tasks = []
+        for update in updates:
+            tasks.append(asyncio.create_task(self._feed(update)))
+            if rate:
+                await asyncio.sleep(1 / rate)
+        await asyncio.gather(*tasks)
+        self.measuring = False
+        self.updates += len(updates)
+
+    def report(self) -> dict:
+        lat = sorted(self.latencies)
+
+        def pct(p: float) -> float:
+            return lat[min(len(lat) - 1, int(p * len(lat)))] * 1000 if lat else 0.0
+
+        return {
+            "updates": self.updates,
+            "p50_ms": pct(0.50),
+            "p99_ms": pct(0.99),
+            "db_per_update": self.queries / max(self.updates, 1),
+            "api_per_update": len(self.session.calls) / max(self.updates, 1),
+        }
+
+
+async def setup_groups(groups: list[int], questions: int, max_attempts: int):
+    for chat_id in groups:
+        await database.register_group(chat_id, f"Group {chat_id}")
+        await database.set_max_attempts(chat_id, max_attempts)
+        for i in range(questions):
+            await database.add_question(chat_id, f"Вопрос {i + 1}?", ANSWER)
+
+
+async def join_raid(run: Run, gen: Updates, users: int, rate: float):
+    chat_id = GROUP_IDS[0]
+    await setup_groups([chat_id], 2, 3)
+    await run.phase([gen.join(chat_id, 10_000 + i) for i in range(users)], rate)
+
+
+async def many_groups(run: Run, gen: Updates, users: int, rate: float):
+    await setup_groups(GROUP_IDS, 2, 3)
+    members = [(GROUP_IDS[i % len(GROUP_IDS)], 20_000 + i) for i in range(users)]
+    await run.phase([gen.join(chat_id, uid) for chat_id, uid in members], rate)
+    await run.phase([gen.private(uid, f"/start {chat_id}") for chat_id, uid in members], rate)
+    for _ in range(2):
+        await run.phase([gen.private(uid, ANSWER) for _, uid in members], rate)
+
+
+async def wrong_storm(run: Run, gen: Updates, users: int, rate: float):
+    chat_id = GROUP_IDS[1]
+    await setup_groups([chat_id], 1, 1000)
+    uids = [30_000 + i for i in range(users)]
+    await run.phase([gen.join(chat_id, uid) for uid in uids], rate)
+    await run.phase([gen.private(uid, f"/start {chat_id}") for uid in uids], rate)
+    for _ in range(5):
+        await run.phase([gen.private(uid, "не знаю") for uid in uids], rate)
+
+
+async def flood(run: Run, gen: Updates, users: int, rate: float):
+    # несколько пользователей шлют ответы очередями: лишнее отсекает Throttle
+    chat_id = GROUP_IDS[2]
+    await setup_groups([chat_id], 1, 1000)
+    uids = [40_000 + i for i in range(max(1, users // 30))]
+    for uid in uids:
+        await run.phase([gen.join(chat_id, uid)], 0)
+        await run.phase([gen.private(uid, f"/start {chat_id}")], 0)
+    await run.phase([gen.private(uid, "не знаю") for _ in range(30) for uid in uids], 0)
+
+
+# сценарий -> (функция, порог p99 в мс, запросов к базе на обновление,
+# вызовов Bot API на обновление)
+SCENARIOS = {
+    "join_raid": (join_raid, 250.0, 12.0, 1.5),
+    "many_groups": (many_groups, 250.0, 12.0, 2.0),
+    "wrong_storm": (wrong_storm, 250.0, 12.0, 1.5),
+    "flood": (flood, 250.0, 3.0, 0.5),
+}
+
+
+async def run_scenario(name: str, users: int, rate: float, latency: float) -> dict:
+    database.DB = os.path.join(tempfile.mkdtemp(prefix="msr-bench-"), "bench.db")
+    # новая сессия без OutboundLimiter: меряем обработчики и базу, а не
+    # искусственный темп исходящих запросов
+    session = FakeSession(latency)
+    session.middleware(metrics.ApiTimer())
+    bot.bot.session = session
+    run = Run(session)
+    await bot.on_startup()
+    try:
+        for conn in database._pool._conns:
+            await conn.set_trace_callback(run.on_query)
+        await SCENARIOS[name][0](run, Updates(), users, rate)
+        for conn in database._pool._conns:
+            await conn.set_trace_callback(None)
+    finally:
+        # те же шаги, что при остановке бота: FSM-хранилище и сверка после
+        # перезапуска не должны пережить сценарий и его базу
+        await bot.on_shutdown()
+    return run.report()
+
+
+# ---------- несколько воркеров ----------
+# Как workers.py, только без HTTP: каждый воркер — отдельный процесс
+# bench.py --worker со своими SHARD_INDEX/SHARD_COUNT и общей базой, а
+# обновления раскладываются по воркерам как в workers.Router (route_key:
+# вступления — по id группы, личные сообщения — по id пользователя). Команды идут
+# воркеру построчно в stdin, в ответ — тексты, которые отправил бот.
+async def worker(db_path: str):
+    database.DB = db_path
+    session = FakeSession()
+    bot.bot.session = session
+    await bot.on_startup()
+    gen = Updates()
+    reader = asyncio.StreamReader()
+    await asyncio.get_running_loop().connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+    )
+    try:
+        while line := await reader.readline():
+            cmd, *args = json.loads(line)
+            sent = len(session.texts)
+            if cmd == "sweep":
+                await bot.sweeper.sweep()
+            else:
+                await bot.dp.feed_update(bot.bot, getattr(gen, cmd)(*args))
+            print(json.dumps(session.texts[sent:], ensure_ascii=False), flush=True)
+    finally:
+        await bot.on_shutdown()
+
+
+class Workers:
+    def __init__(self, db_path: str, count: int):
+        self.db_path = db_path
+        self.count = count
+        self.procs: list[asyncio.subprocess.Process] = []
+
+    async def start(self):
+        for i in range(self.count):
+            env = {**os.environ, "SHARD_INDEX": str(i), "SHARD_COUNT": str(self.count)}
+            self.procs.append(
+                await asyncio.create_subprocess_exec(
+                    sys.executable, os.path.abspath(__file__), "--worker", self.db_path,
+                    env=env, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                )
+            )
+
+    async def send(self, shard: int, *cmd) -> list[str]:
+        proc = self.procs[shard]
+        proc.stdin.write(json.dumps(cmd).encode() + b"\n")
+        await proc.stdin.drain()
+        return json.loads(await proc.stdout.readline())
+
+    async def user(self, uid: int, *cmd) -> list[str]:
+        return await self.send(uid % self.count, *cmd)
+
+    async def group(self, chat_id: int, *cmd) -> list[str]:
+        return await self.send(chat_id % self.count, *cmd)
+
+    async def stop(self):
+        for proc in self.procs:
+            proc.stdin.close()
+        await asyncio.gather(*(proc.wait() for proc in self.procs))
+
+
+async def expire_shards(users: int, count: int) -> dict:
+    # Пользователь ждёт проверки в двух группах, в A срок выходит, и её
+    # выгоняет ExpirySweeper первого воркера. Воркер пользователя должен
+    # сам заметить, что проверка в A закончилась, и принять ответ в B.
+    chat_a, chat_b = GROUP_IDS[0], GROUP_IDS[1]
+    db_path = os.path.join(tempfile.mkdtemp(prefix="msr-bench-"), "bench.db")
+    database.DB = db_path
+    await database.init()
+    await setup_groups([chat_a, chat_b], 1, 3)
+    await database.set_verify_timeout(chat_a, 1)
+    await database.close()
+
+    workers = Workers(db_path, count)
+    await workers.start()
+    uids = [50_000 + i for i in range(users)]
+    try:
+        for uid in uids:
+            await workers.group(chat_b, "join", chat_b, uid)
+            await workers.group(chat_a, "join", chat_a, uid)
+            await workers.user(uid, "private", uid, f"/start {chat_b}")
+            await workers.user(uid, "private", uid, f"/start {chat_a}")
+            # ответ в A: воркер запоминает ожидающие группы пользователя
+            await workers.user(uid, "private", uid, "не знаю")
+        await asyncio.sleep(1.5)
+        await workers.send(0, "sweep")
+        verified = 0
+        for uid in uids:
+            replies = await workers.user(uid, "private", uid, ANSWER)
+            if not any("ответили на все" in text for text in replies):
+                replies = await workers.user(uid, "private", uid, ANSWER)
+            verified += any("ответили на все" in text for text in replies)
+    finally:
+        await workers.stop()
+    return {"users": len(uids), "verified": verified}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на синтетических обновлениях")
+    parser.add_argument("scenarios", nargs="*", help=f"по умолчанию все: {', '.join(SCENARIOS)}, expire_shards")
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--rate", type=float, default=300, help="обновлений в секунду, 0 — без паузы")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа Bot API, сек")
+    parser.add_argument("--slack", type=float, default=1.0, help="множитель порогов регрессии")
+    parser.add_argument("--workers", type=int, default=2, help="воркеров в проверке expire_shards, 0 — пропустить")
+    parser.add_argument("--worker", metavar="DB", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return await worker(args.worker)
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    unknown = set(args.scenarios) - set(SCENARIOS) - {"expire_shards"}
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+
+    failed = False
+    print(f"{'сценарий':<14}{'обновл.':>8}{'p50 мс':>9}{'p99 мс':>9}{'БД/обн':>8}{'API/обн':>9}")
+    for name in [n for n in args.scenarios or SCENARIOS if n in SCENARIOS]:
+        r = await run_scenario(name, args.users, args.rate, args.latency)
+        _, max_p99, max_db, max_api = SCENARIOS[name]
+        bad = [
+            label
+            for label, value, limit in (
+                ("p99", r["p99_ms"], max_p99),
+                ("БД", r["db_per_update"], max_db),
+                ("API", r["api_per_update"], max_api),
+            )
+            if value > limit * args.slack
+        ]
+        failed |= bool(bad)
+        print(
+            f"{name:<14}{r['updates']:>8}{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}"
+            f"{r['db_per_update']:>8.2f}{r['api_per_update']:>9.2f}"
+            + (f"  РЕГРЕССИЯ: {', '.join(bad)}" if bad else "")
+        )
+    if args.workers and (not args.scenarios or "expire_shards" in args.scenarios):
+        r = await expire_shards(max(1, args.users // 30), args.workers)
+        bad = r["verified"] < r["users"]
+        failed |= bad
+        print(
+            f"{'expire_shards':<14}{r['users']:>8}  воркеров {args.workers}, прошли проверку {r['verified']}"
+            + ("  РЕГРЕССИЯ" if bad else "")
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
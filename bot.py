@@ -1,8 +1,14 @@
+import time
+
+# отсчёт времени запуска: импорт aiogram, прогрев и первое обновление
+STARTED = time.perf_counter()
+
+import html
 import logging
-import os
 import asyncio
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import (
+    BufferedInputFile,
     ChatMemberUpdated,
     Message,
     ChatPermissions,
@@ -13,24 +19,71 @@ from aiogram.types import (
 from aiogram.filters import Command
 from aiogram.enums.chat_type import ChatType
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.fsm.context import FSMContext
-from dotenv import load_dotenv
 import database
+import metrics
+from config import (
+    BOT_TOKEN,
+    METRICS_HOST,
+    METRICS_PORT,
+    OUTBOUND_CHAT_BURST,
+    OUTBOUND_CHAT_RATE,
+    OUTBOUND_GLOBAL_RATE,
+    SHARD_COUNT,
+    SHARD_INDEX,
+    SUPER_ADMINS,
+    TRANSPORT,
+)
+from expiry import ExpirySweeper
+from outbound import LOW, OutboundLimiter
+from raid import RaidMode
+from retention import LogArchiver
+from scheduler import DeletionScheduler
+from storage import SQLiteStorage
+from throttle import Throttle
 
-load_dotenv()
-
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-SUPER_ADMINS = [int(x) for x in os.getenv("SUPER_ADMINS", "").split(",") if x]
-GROUPS = [int(x) for x in os.getenv("GROUPS", "").split(",") if x]
 DELETE_AFTER = 120
+PAGE_SIZE = 10
+RAID_MAX_NAMES = 30
 
 logging.basicConfig(level=logging.INFO)
-storage = MemoryStorage()
+log = logging.getLogger(__name__)
+storage = SQLiteStorage()
 bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+# лимиты Telegram, общий и на чат, делятся между воркерами поровну: в один
+# чат пишут и воркер группы (приветствия), и воркеры пользователей (итоги проверки)
+limiter = OutboundLimiter(
+    global_rate=OUTBOUND_GLOBAL_RATE / max(1, SHARD_COUNT),
+    chat_rate=OUTBOUND_CHAT_RATE / max(1, SHARD_COUNT),
+    chat_burst=max(1, OUTBOUND_CHAT_BURST // max(1, SHARD_COUNT)),
+)
+bot.session.middleware(limiter)
+bot.session.middleware(metrics.ApiTimer())
 dp = Dispatcher(storage=storage)
+# флуд отсекается раньше фильтров и базы
+throttle = Throttle()
+dp.message.outer_middleware(throttle)
+dp.callback_query.outer_middleware(throttle)
+for observer in (dp.message, dp.callback_query, dp.chat_member, dp.my_chat_member):
+    observer.middleware(metrics.HandlerTimer())
+deleter = DeletionScheduler(bot)
+archiver = LogArchiver()
+sweeper = ExpirySweeper(bot)
+metrics_runner = None
+reconcile_task: asyncio.Task | None = None
+first_update_at: float | None = None
+RECONCILE_BATCH = 100
+
+metrics.DELETIONS_PENDING.read = lambda: deleter.depth
+metrics.LOG_QUEUE.read = database.log_queue_depth
+metrics.OUTBOUND_WAITING.read = lambda: limiter.waiting
+metrics.STARTUP_SECONDS.read = lambda: first_update_at or 0
 
 EXPECT_QA_KEY = "expect_qa_chat"
+EXPECT_IMPORT_KEY = "expect_import_chat"
+MAX_IMPORT_BYTES = 1024 * 1024
 bot_username: str | None = None
 
 
@@ -52,23 +105,74 @@ async def restrict(chat_id: int, user_id: int, restrict: bool):
     await bot.restrict_chat_member(chat_id, user_id, permissions=perms)
 
 
-async def delete_msg_after(chat_id: int, message_id: int, delay: int):
-    await asyncio.sleep(delay)
-    try:
-        await bot.delete_message(chat_id, message_id)
-    except Exception:
-        pass
+# Списки групп и вопросов показываются страницами. Курсор страницы живёт в
+# callback_data кнопок: "" — первая страница, "a<ключ>" — после ключа,
+# "b<ключ>" — перед ключом (кнопка «назад»).
+def parse_cursor(raw: str) -> tuple[int | None, bool]:
+    if not raw:
+        return None, False
+    return int(raw[1:]), raw[0] == "b"
+
+
+def nav_row(prefix: str, page: database.Page) -> list[InlineKeyboardButton]:
+    row = []
+    if page.before is not None:
+        row.append(InlineKeyboardButton(text="« Назад", callback_data=f"{prefix}b{page.before}"))
+    if page.after is not None:
+        row.append(InlineKeyboardButton(text="Далее »", callback_data=f"{prefix}a{page.after}"))
+    return row
+
+
+def start_groups_kb(page: database.Page) -> InlineKeyboardMarkup:
+    kb_rows = [
+        [InlineKeyboardButton(text=title, url=f"https://t.me/{bot_username}?start={cid}")]
+        for cid, title in page.rows
+    ]
+    if nav := nav_row("sg_", page):
+        kb_rows.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=kb_rows)
+
+
+def admin_groups_kb(page: database.Page) -> InlineKeyboardMarkup:
+    kb_rows = [
+        [InlineKeyboardButton(text=str(title), callback_data=f"pick_{cid}")]
+        for cid, title in page.rows
+    ]
+    if nav := nav_row("ag_", page):
+        kb_rows.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=kb_rows)
+
+
+async def admin_groups_page(user_id: int, cursor: str = "") -> database.Page:
+    # супер-админ видит все группы, остальные — только свои
+    after, backward = parse_cursor(cursor)
+    admin_id = None if user_id in SUPER_ADMINS else user_id
+    return await database.get_groups_page(after, backward, PAGE_SIZE, admin_id=admin_id)
+
+
+async def announce_raid(chat_id: int, names: list[str]):
+    shown = ", ".join(html.escape(n) for n in names[:RAID_MAX_NAMES])
+    if len(names) > RAID_MAX_NAMES:
+        shown += f" и ещё {len(names) - RAID_MAX_NAMES}"
+    msg = await bot.send_message(
+        chat_id,
+        f"Добро пожаловать, {shown}!\n"
+        f"Если вы не знаете ответ на вопрос напишите @constantintesla!\n"
+        f"Пройдите проверку: нажмите /start у @{bot_username}?start={chat_id}",
+    )
+    await deleter.schedule(chat_id, msg.message_id, DELETE_AFTER)
+
+
+raid = RaidMode(announce_raid)
 
 
 # ---------- Вступление ----------
 @dp.chat_member()
 async def on_member(event: ChatMemberUpdated):
-    if event.new_chat_member.status == "member" and event.chat.id in GROUPS:
+    if event.new_chat_member.status == "member" and await database.is_active_group(event.chat.id):
         user = event.new_chat_member.user
         chat_id = event.chat.id
-        title = event.chat.title or str(chat_id)
 
-        await database.ensure_group(chat_id, title)
         questions = await database.get_questions(chat_id)
 
         if not questions:
@@ -77,20 +181,41 @@ async def on_member(event: ChatMemberUpdated):
                 f"{user.full_name} вступил в группу, но в ней нет вопросов для проверки. "
                 f"Добавьте вопросы через админку.",
             )
-            asyncio.create_task(delete_msg_after(chat_id, msg.message_id, DELETE_AFTER))
+            await deleter.schedule(chat_id, msg.message_id, DELETE_AFTER)
             return
 
-        await database.upsert_user_state(
-            user.id, chat_id, status="not_verified", attempts=0, current_q_index=0
-        )
+        if not await database.start_verification(user.id, chat_id):
+            # уже прошёл проверку или забанен (вступление могло прийти в воркер
+            # группы позже, чем ответы — в воркер пользователя)
+            return
         await restrict(chat_id, user.id, True)
+        if raid.joined(chat_id, user.full_name):
+            return
         msg = await bot.send_message(
             chat_id,
             f"Добро пожаловать, {user.full_name}!\n"
             f"Если вы не знаете ответ на вопрос напишите @constantintesla!\n"
             f"Пройдите проверку: нажмите /start у @{bot_username}?start={chat_id}",
         )
-        asyncio.create_task(delete_msg_after(chat_id, msg.message_id, DELETE_AFTER))
+        await deleter.schedule(chat_id, msg.message_id, DELETE_AFTER)
+
+
+# ---------- Подключение групп ----------
+# Группа начинает работать, как только бота делают в ней админом: без
+# прав админа он не может ограничивать новичков. Кто повысил бота, становится
+# админом группы в админке. Если бота понизили или удалили, группа
+# отключается, а её вопросы и настройки остаются.
+@dp.my_chat_member(F.chat.type.in_({ChatType.GROUP, ChatType.SUPERGROUP}))
+async def on_bot_member(event: ChatMemberUpdated):
+    chat_id = event.chat.id
+    if event.new_chat_member.status == "administrator":
+        await database.register_group(chat_id, event.chat.title)
+        if not event.from_user.is_bot:
+            await database.add_admin(chat_id, event.from_user.id)
+        log.info("Группа %s (%s) подключена", chat_id, event.chat.title)
+    elif event.old_chat_member.status == "administrator":
+        await database.unregister_group(chat_id)
+        log.info("Группа %s отключена", chat_id)
 
 
 # ---------- /start ----------dw
@@ -100,18 +225,13 @@ async def cmd_start_private(message: Message, command: Command):
     try:
         chat_id = int(command.args)
     except (TypeError, ValueError):
-        groups = await database.get_groups_info()
-        kb_rows = [
-            [InlineKeyboardButton(text=title, url=f"https://t.me/{bot_username}?start={cid}")]
-            for cid, title in groups
-        ]
-        kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
+        page = await database.get_groups_page(limit=PAGE_SIZE)
         return await message.answer(
             "Выберите группу, в которой хотите пройти проверку:",
-            reply_markup=kb,
+            reply_markup=start_groups_kb(page),
         )
 
-    if chat_id not in GROUPS:
+    if not await database.is_active_group(chat_id):
         return await message.answer("Неверная ссылка.")
 
     questions = await database.get_questions(chat_id)
@@ -129,58 +249,55 @@ async def cmd_start_private(message: Message, command: Command):
 @dp.message(F.chat.type == ChatType.PRIVATE)
 async def answer_handler(message: Message, state: FSMContext):
     data = await state.get_data()
-    if data.get(EXPECT_QA_KEY):
+    if data.get(EXPECT_QA_KEY) or data.get(EXPECT_IMPORT_KEY):
+        # админ присылает вопросы — сообщение для обработчиков ниже
+        raise SkipHandler()
+
+    if (message.text or "").startswith("/"):
+        # команды (/admin и др.) обрабатываются ниже
+        raise SkipHandler()
+    if message.text is None:
+        # стикер, фото, голосовое — не ответ, попытку не тратим
         return
 
     user = message.from_user
-    for gid in GROUPS:
-        st_row = await database.get_user_state(user.id, gid)
-        if st_row and st_row[0] == "not_verified":
-            chat_id = gid
-            break
-    else:
+    chat_id = await database.get_pending_chat(user.id)
+    if chat_id is None or not await database.is_active_group(chat_id):
         return
 
-    questions = await database.get_questions(chat_id)
-    idx = (await database.get_user_state(user.id, chat_id))[2]
-    q, a = questions[idx][1], questions[idx][2]
-    given = message.text.strip().lower()
-    ok = given == a.lower()
-    max_attempts = await database.get_max_attempts(chat_id)
-
-    await database.log_answer(
-        chat_id, user.id, user.username or "", q, message.text, ok
+    res = await database.process_answer(
+        user.id, chat_id, user.username or "", message.text
     )
+    if res is None:
+        # проверка в этой группе уже закончилась (например, вышел срок) —
+        # напоминаем вопрос группы, где пользователь ещё ждёт проверки
+        next_chat = await database.get_pending_chat(user.id)
+        if next_chat is not None and next_chat != chat_id:
+            row = await database.get_user_state(user.id, next_chat)
+            questions = await database.get_questions(next_chat)
+            if row is not None and row[2] < len(questions):
+                await message.answer(f"Ответьте на вопрос:\n<b>{questions[row[2]][1]}</b>")
+        return
 
-    if ok:
-        idx += 1
-        if idx < len(questions):
-            next_q, next_a = questions[idx][1], questions[idx][2]
-            await database.update_user_state(
-                user.id, chat_id, current_q_index=idx, attempts=0
-            )
-            await message.answer(f"✅ Верно! Следующий вопрос:\n<b>{next_q}</b>")
-        else:
-            await database.update_user_state(user.id, chat_id, status="verified")
-            await restrict(chat_id, user.id, False)
-            await message.answer(
-                "Отлично! Вы ответили на все вопросы, добро пожаловать в группу."
-            )
-            msg = await bot.send_message(chat_id, f"{user.full_name} прошёл проверку!")
-            asyncio.create_task(delete_msg_after(chat_id, msg.message_id, DELETE_AFTER))
+    if res.outcome == "next":
+        await message.answer(f"✅ Верно! Следующий вопрос:\n<b>{res.next_question}</b>")
+    elif res.outcome == "verified":
+        await restrict(chat_id, user.id, False)
+        await database.mark_unrestricted([(user.id, chat_id)])
+        await message.answer(
+            "Отлично! Вы ответили на все вопросы, добро пожаловать в группу."
+        )
+        msg = await bot.send_message(chat_id, f"{user.full_name} прошёл проверку!")
+        await deleter.schedule(chat_id, msg.message_id, DELETE_AFTER)
+    elif res.outcome == "banned":
+        await message.answer("Превышено число попыток, вы заблокированы.")
+        await bot.ban_chat_member(chat_id, user.id)
+        msg = await bot.send_message(chat_id, f"{user.full_name} заблокирован за попытки.")
+        await deleter.schedule(chat_id, msg.message_id, DELETE_AFTER)
     else:
-        attempts = (await database.get_user_state(user.id, chat_id))[1] + 1
-        await database.update_user_state(user.id, chat_id, attempts=attempts)
-        if attempts >= max_attempts:
-            await database.update_user_state(user.id, chat_id, status="banned")
-            await message.answer("Превышено число попыток, вы заблокированы.")
-            await bot.ban_chat_member(chat_id, user.id)
-            msg = await bot.send_message(chat_id, f"{user.full_name} заблокирован за попытки.")
-            asyncio.create_task(delete_msg_after(chat_id, msg.message_id, DELETE_AFTER))
-        else:
-            await message.answer(
-                f"Неверно, попробуйте ещё раз (осталось {max_attempts - attempts})."
-            )
+        await message.answer(
+            f"Неверно, попробуйте ещё раз (осталось {res.attempts_left})."
+        )
 
 
 # ---------- Назначение админов ----------
@@ -204,13 +321,10 @@ async def cmd_addadmin(message: Message):
 async def cmd_admin(message: Message):
     user_id = message.from_user.id
     if message.chat.type == ChatType.PRIVATE:
-        groups = await database.get_groups_info()
-        kb_rows = [
-            [InlineKeyboardButton(text=title, callback_data=f"pick_{cid}")]
-            for cid, title in groups
-        ]
-        kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
-        return await message.answer("Выберите группу:", reply_markup=kb)
+        page = await admin_groups_page(user_id)
+        if not page.rows:
+            return await message.answer("Вы не админ ни одной группы.")
+        return await message.answer("Выберите группу:", reply_markup=admin_groups_kb(page))
 
     chat_id = message.chat.id
     if not await database.is_admin(chat_id, user_id):
@@ -221,12 +335,29 @@ async def cmd_admin(message: Message):
             [InlineKeyboardButton(text="➕ Добавить вопрос", callback_data=f"addq_{chat_id}")],
             [InlineKeyboardButton(text="🔍 Вопросы", callback_data=f"listq_{chat_id}")],
             [InlineKeyboardButton(text="⚙️ Попытки", callback_data=f"att_{chat_id}")],
+            [
+                InlineKeyboardButton(text="📥 Импорт", callback_data=f"impq_{chat_id}"),
+                InlineKeyboardButton(text="📤 Экспорт", callback_data=f"expq_{chat_id}"),
+            ],
         ]
     )
     await message.answer("Панель управления:", reply_markup=kb)
 
 
 # ---------- Коллбэки ----------
+@dp.callback_query(F.data.startswith("sg_"))
+async def start_groups_cb(callback: CallbackQuery):
+    after, backward = parse_cursor(callback.data[3:])
+    page = await database.get_groups_page(after, backward, PAGE_SIZE)
+    await callback.message.edit_reply_markup(reply_markup=start_groups_kb(page))
+
+
+@dp.callback_query(F.data.startswith("ag_"))
+async def admin_groups_cb(callback: CallbackQuery):
+    page = await admin_groups_page(callback.from_user.id, callback.data[3:])
+    await callback.message.edit_reply_markup(reply_markup=admin_groups_kb(page))
+
+
 @dp.callback_query(F.data.startswith("pick_"))
 async def pick_group(callback: CallbackQuery):
     chat_id = int(callback.data.split("_", 1)[1])
@@ -239,6 +370,10 @@ async def pick_group(callback: CallbackQuery):
             [InlineKeyboardButton(text="➕ Добавить вопрос", callback_data=f"addq_{chat_id}")],
             [InlineKeyboardButton(text="🔍 Вопросы", callback_data=f"listq_{chat_id}")],
             [InlineKeyboardButton(text="⚙️ Попытки", callback_data=f"att_{chat_id}")],
+            [
+                InlineKeyboardButton(text="📥 Импорт", callback_data=f"impq_{chat_id}"),
+                InlineKeyboardButton(text="📤 Экспорт", callback_data=f"expq_{chat_id}"),
+            ],
         ]
     )
     await callback.message.edit_text(f"Управление группой {chat_id}:", reply_markup=kb)
@@ -270,7 +405,8 @@ async def addq_cb(callback: CallbackQuery, state: FSMContext):
     await callback.bot.send_message(
         user_id,
         f"Отправьте новый вопрос и ответ для группы {chat_id}:\n"
-        "<code>Вопрос|ответ</code>",
+        "<code>Вопрос|ответ</code>\n"
+        "Если верных ответов несколько, перечислите их: <code>Вопрос|ответ|другой ответ</code>",
         parse_mode="HTML",
     )
     await state.set_data({EXPECT_QA_KEY: chat_id})
@@ -293,33 +429,103 @@ async def add_question_handler(message: Message, state: FSMContext):
         await state.clear()
 
 
-@dp.callback_query(F.data.startswith("listq_"))
-async def listq_cb(callback: CallbackQuery):
+@dp.callback_query(F.data.startswith("impq_"))
+async def impq_cb(callback: CallbackQuery, state: FSMContext):
+    chat_id = int(callback.data.split("_", 1)[1])
+    user_id = callback.from_user.id
+    if not await database.is_admin(chat_id, user_id):
+        return await callback.answer("Нет доступа")
+    await callback.bot.send_message(
+        user_id,
+        f"Отправьте файл с вопросами для группы {chat_id}: CSV с колонками "
+        "<code>вопрос,ответ</code> или JSON. Вопросы добавятся к текущим; "
+        "чтобы заменить их, подпишите файл словом <code>заменить</code>.",
+    )
+    await state.set_data({EXPECT_IMPORT_KEY: chat_id})
+    await callback.answer("Ожидаю файл в личке.")
+
+
+@dp.message(F.document, F.chat.type == ChatType.PRIVATE)
+async def import_questions_handler(message: Message, state: FSMContext):
+    data = await state.get_data()
+    chat_id = data.get(EXPECT_IMPORT_KEY)
+    if not chat_id or not await database.is_admin(chat_id, message.from_user.id):
+        return
+    document = message.document
+    import question_sets
+
+    if document.file_size and document.file_size > MAX_IMPORT_BYTES:
+        return await message.answer("Файл больше 1 МБ.")
+    buf = await bot.download(document)
+    try:
+        pairs = question_sets.parse(buf.read(), document.file_name or "")
+    except ValueError as e:
+        # состояние не сбрасываем: можно исправить файл и прислать снова
+        return await message.answer(f"Файл не импортирован:\n{html.escape(str(e))}")
+    replace = (message.caption or "").strip().lower() == "заменить"
+    await database.import_questions([chat_id], pairs, replace=replace)
+    await state.clear()
+    await message.answer(f"Импортировано вопросов: {len(pairs)}" + (" (старые удалены)." if replace else "."))
+
+
+@dp.callback_query(F.data.startswith("expq_"))
+async def expq_cb(callback: CallbackQuery):
     chat_id = int(callback.data.split("_", 1)[1])
     user_id = callback.from_user.id
     if not await database.is_admin(chat_id, user_id):
         return await callback.answer("Нет доступа")
     questions = await database.get_questions(chat_id)
-    kb_rows = []
-    for qid, q, a in questions:
-        kb_rows.append(
-            [InlineKeyboardButton(text=q[:30], callback_data=f"delq_{chat_id}_{qid}")]
-        )
+    if not questions:
+        return await callback.answer("Вопросов нет")
+    import question_sets
+
+    data = question_sets.to_csv([(q, a) for _, q, a, _ in questions])
+    await callback.bot.send_document(
+        user_id, BufferedInputFile(data, filename=f"questions_{chat_id}.csv")
+    )
+    await callback.answer("Отправил файл в личку.")
+
+
+async def show_questions(callback: CallbackQuery, chat_id: int, cursor: str = ""):
+    after, backward = parse_cursor(cursor)
+    page = await database.get_questions_page(chat_id, after, backward, PAGE_SIZE)
+    if not page.rows and after is not None:
+        # удалили последний вопрос страницы — возвращаемся к началу
+        cursor = ""
+        page = await database.get_questions_page(chat_id, limit=PAGE_SIZE)
+    kb_rows = [
+        [InlineKeyboardButton(text=q[:30], callback_data=f"delq_{chat_id}_{qid}_{cursor}")]
+        for qid, q, _ in page.rows
+    ]
+    if nav := nav_row(f"listq_{chat_id}_", page):
+        kb_rows.append(nav)
     kb_rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data=f"pick_{chat_id}")])
     kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
     await callback.message.edit_text("Нажмите чтобы удалить:", reply_markup=kb)
 
 
+@dp.callback_query(F.data.startswith("listq_"))
+async def listq_cb(callback: CallbackQuery):
+    # listq_<chat_id>[_<курсор>]
+    _, chat_id_str, *cursor = callback.data.split("_")
+    chat_id = int(chat_id_str)
+    user_id = callback.from_user.id
+    if not await database.is_admin(chat_id, user_id):
+        return await callback.answer("Нет доступа")
+    await show_questions(callback, chat_id, cursor[0] if cursor else "")
+
+
 @dp.callback_query(F.data.startswith("delq_"))
 async def delq_cb(callback: CallbackQuery):
-    _, chat_id_str, qid_str = callback.data.split("_")
+    # delq_<chat_id>_<id вопроса>[_<курсор страницы>]
+    _, chat_id_str, qid_str, *cursor = callback.data.split("_")
     chat_id, qid = int(chat_id_str), int(qid_str)
     user_id = callback.from_user.id
     if not await database.is_admin(chat_id, user_id):
         return await callback.answer("Нет доступа")
     await database.delete_question(qid)
     await callback.answer("Удалено")
-    await listq_cb(callback)
+    await show_questions(callback, chat_id, cursor[0] if cursor else "")
 
 
 @dp.callback_query(F.data.startswith("att_"))
@@ -359,16 +565,102 @@ async def setatt_cb(callback: CallbackQuery):
 
 
 # ---------- Запуск ----------
+@dp.update.outer_middleware()
+async def first_update(handler, event, data):
+    global first_update_at
+    try:
+        return await handler(event, data)
+    finally:
+        if first_update_at is None:
+            first_update_at = time.perf_counter() - STARTED
+            log.info("Первое обновление обработано через %.0f мс после запуска", first_update_at * 1000)
+
+
+async def reconcile():
+    # После перезапуска: снимаем ограничения с прошедших проверку, если бот
+    # не успел этого сделать, и даём срок ожидающим без срока. Идёт в фоне
+    # в темпе ExpirySweeper и не задерживает первые обновления.
+    try:
+        requeued = await database.requeue_pending()
+        released = 0
+        while rows := await database.get_unreleased(RECONCILE_BATCH):
+            done = []
+            for user_id, chat_id in rows:
+                await sweeper.bucket.acquire(LOW)
+                try:
+                    await restrict(chat_id, user_id, False)
+                except (TelegramBadRequest, TelegramForbiddenError) as e:
+                    # пользователь ушёл или у бота нет прав — повтор не поможет
+                    log.info("Не удалось снять ограничение с %s в %s: %s", user_id, chat_id, e)
+                except Exception as e:
+                    # 429 после всех повторов, сеть — строка остаётся на следующий проход
+                    log.warning("Ограничение с %s в %s не снято, повторим: %s", user_id, chat_id, e)
+                    continue
+                done.append((user_id, chat_id))
+            await database.mark_unrestricted(done)
+            released += len(done)
+            if len(done) < len(rows):
+                await asyncio.sleep(sweeper.interval_sec)
+        if requeued or released:
+            log.info("После перезапуска: сроки назначены %d, ограничения сняты %d", requeued, released)
+    except Exception:
+        log.exception("Сверка после перезапуска не удалась")
+
+
 async def on_startup():
-    global bot_username
-    me = await bot.get_me()
+    global bot_username, metrics_runner, reconcile_task
+    # bot.me() запоминает ответ, поэтому start_polling не спрашивает его снова
+    me, _ = await asyncio.gather(bot.me(), database.init())
     bot_username = me.username
-    await database.init()
+    warm = await database.warm_up()
+    storage.start()
+    # каждый воркер поднимает свои задания на удаление; архивация, выгон
+    # просроченных и сверка достаются только первому, иначе выполнялись бы N раз
+    await deleter.load()
+    if SHARD_INDEX == 0:
+        archiver.start()
+        sweeper.start()
+        reconcile_task = asyncio.create_task(reconcile())
+    deleter.start()
+    if METRICS_PORT:
+        metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+    log.info(
+        "Готов за %.0f мс: групп %d, вопросов %d, ожидают проверки %d",
+        (time.perf_counter() - STARTED) * 1000,
+        warm["groups"],
+        warm["questions"],
+        warm["pending"],
+    )
+
+
+async def on_shutdown():
+    global reconcile_task
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    if reconcile_task is not None:
+        reconcile_task.cancel()
+        await asyncio.gather(reconcile_task, return_exceptions=True)
+        reconcile_task = None
+    await raid.stop()
+    await archiver.stop()
+    await sweeper.stop()
+    await deleter.stop()
+    await storage.close()
+    await database.close()
+    await bot.session.close()
 
 
 async def main():
     await on_startup()
-    await dp.start_polling(bot)
+    try:
+        if TRANSPORT == "webhook":
+            import webhook
+
+            await webhook.serve(dp, bot)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await on_shutdown()
 
 
 if __name__ == "__main__":
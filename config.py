@@ -4,6 +4,79 @@ from dotenv import load_dotenv
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-SUPER_ADMINS = [int(x) for x in os.getenv("SUPER_ADMINS", "").split(",") if x]
+SUPER_ADMINS = frozenset(int(x) for x in os.getenv("SUPER_ADMINS", "").split(",") if x)
+# начальный список групп; дальше группы подключаются сами, когда бота
+# делают админом, или из админки
 GROUPS = [int(x) for x in os.getenv("GROUPS", "").split(",") if x]
-DEFAULT_ATTEMPTS = int(os.getenv("DEFAULT_ATTEMPTS", 3))
\ No newline at end of file
+DEFAULT_ATTEMPTS = int(os.getenv("DEFAULT_ATTEMPTS", 3))
+TRANSPORT = os.getenv("TRANSPORT", "polling")  # polling | webhook
+
+# метрики Prometheus (порт 0 — не поднимать)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9101))
+
+# база
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+QUESTIONS_RECHECK_SEC = float(os.getenv("QUESTIONS_RECHECK_SEC", 5))
+REGISTRY_RECHECK_SEC = float(os.getenv("REGISTRY_RECHECK_SEC", 5))
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", 60))
+ADMIN_DATA_TTL = float(os.getenv("ADMIN_DATA_TTL", 30))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", 200))
+LOG_FLUSH_MS = int(os.getenv("LOG_FLUSH_MS", 500))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10_000))
+LOG_QUEUE_POLICY = os.getenv("LOG_QUEUE_POLICY", "block")  # block | drop
+FSM_FLUSH_MS = int(os.getenv("FSM_FLUSH_MS", 1000))
+FSM_TTL_SEC = float(os.getenv("FSM_TTL_SEC", 86400))
+
+# хранение и архив answers_log (0 — без ограничения)
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", 90))
+LOG_MAX_ROWS = int(os.getenv("LOG_MAX_ROWS", 0))
+LOG_ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", "archive")
+LOG_ARCHIVE_INTERVAL_SEC = float(os.getenv("LOG_ARCHIVE_INTERVAL_SEC", 3600))
+LOG_ARCHIVE_CHUNK = int(os.getenv("LOG_ARCHIVE_CHUNK", 1000))
+
+# исходящие запросы к Telegram
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", 30))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", 5))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", 3))
+
+# срок проверки: через сколько секунд не прошедших проверку выгонять
+# (0 — никогда, для группы можно задать своё), kick — выгнать, ban — забанить;
+# как часто искать просроченных, сколько брать за раз и сколько выгонять в секунду
+VERIFY_TIMEOUT_SEC = int(os.getenv("VERIFY_TIMEOUT_SEC", 86400))
+VERIFY_EXPIRE_ACTION = os.getenv("VERIFY_EXPIRE_ACTION", "kick")  # kick | ban
+EXPIRE_SWEEP_SEC = float(os.getenv("EXPIRE_SWEEP_SEC", 60))
+EXPIRE_BATCH = int(os.getenv("EXPIRE_BATCH", 100))
+EXPIRE_RATE = float(os.getenv("EXPIRE_RATE", 5))
+
+# сколько опечаток прощать в ответе (0 — только точное совпадение
+# после нормализации регистра, ё/е, пробелов и знаков препинания)
+ANSWER_MAX_TYPOS = int(os.getenv("ANSWER_MAX_TYPOS", 0))
+
+# личные сообщения и кнопки от одного пользователя: сколько в секунду,
+# какой всплеск допустим и скольких пользователей помнить
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", 1))
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", 5))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", 100_000))
+
+# режим рейда
+RAID_JOINS_PER_MIN = int(os.getenv("RAID_JOINS_PER_MIN", 20))
+RAID_WINDOW_SEC = float(os.getenv("RAID_WINDOW_SEC", 10))
+
+# webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", 100))
+WEBHOOK_DRAIN_SEC = float(os.getenv("WEBHOOK_DRAIN_SEC", 30))
+
+# несколько воркеров (workers.py): сколько процессов, с какого порта они
+# слушают и номер текущего воркера (его выставляет workers.py)
+WORKERS = int(os.getenv("WORKERS", os.cpu_count() or 1))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", 8100))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", 0))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 1))
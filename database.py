@@ -1,17 +1,121 @@
+import asyncio
 import aiosqlite
-import os
+import functools
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import NamedTuple
+
+import matching
+import metrics
+
+from config import (
+    ADMIN_CACHE_TTL,
+    DB_BUSY_TIMEOUT_MS,
+    DB_POOL_SIZE,
+    DEFAULT_ATTEMPTS,
+    GROUPS,
+    LOG_BATCH_SIZE,
+    LOG_FLUSH_MS,
+    LOG_MAX_ROWS,
+    LOG_QUEUE_POLICY,
+    LOG_QUEUE_SIZE,
+    LOG_RETENTION_DAYS,
+    QUESTIONS_RECHECK_SEC,
+    REGISTRY_RECHECK_SEC,
+    SUPER_ADMINS,
+    VERIFY_TIMEOUT_SEC,
+)
 
 DB = "database.db"
+STATEMENT_CACHE = 256
+PENDING_CACHE_SIZE = 50_000
+
+log = logging.getLogger(__name__)
+
+
+# ---------- пул соединений ----------
+# Соединения открываются один раз в init() и живут до close(),
+# поэтому запрос не платит за новый поток и открытие файла.
+class Pool:
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = max(1, size)
+        self._conns: list[aiosqlite.Connection] = []
+        self._free: asyncio.Queue | None = None
+
+    async def open(self):
+        self._free = asyncio.Queue()
+        for _ in range(self.size):
+            conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE)
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute("PRAGMA synchronous=NORMAL")
+            await conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+            self._conns.append(conn)
+            self._free.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._conns:
+            await conn.close()
+        self._conns.clear()
+        self._free = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        conn = await self._free.get()
+        try:
+            yield conn
+        except BaseException:
+            # незакоммиченная транзакция не должна уехать обратно в пул
+            await conn.rollback()
+            raise
+        finally:
+            self._free.put_nowait(conn)
+
+
+_pool: Pool | None = None
+_log_writer: "LogWriter | None" = None
+
+
+def connection():
+    if _pool is None:
+        raise RuntimeError("database.init() ещё не вызван")
+    return _pool.acquire()
+
+
+# время каждого запроса пишется в гистограмму msr_db_seconds под именем функции
+def _timed(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            metrics.DB_SECONDS.observe(name, time.perf_counter() - started)
+
+    return wrapper
 
 
 # ---------- инициализация ----------
 async def init():
-    async with aiosqlite.connect(DB) as db:
+    global _pool, _log_writer
+    if _pool is None:
+        pool = Pool(DB, DB_POOL_SIZE)
+        await pool.open()
+        _pool = pool
+    if _log_writer is None:
+        _log_writer = LogWriter(LOG_BATCH_SIZE, LOG_FLUSH_MS, LOG_QUEUE_SIZE, LOG_QUEUE_POLICY)
+        _log_writer.start()
+    async with connection() as db:
         await db.executescript("""
             CREATE TABLE IF NOT EXISTS groups(
                 chat_id INTEGER PRIMARY KEY,
                 title   TEXT,
-                max_attempts INTEGER NOT NULL DEFAULT 3
+                max_attempts INTEGER NOT NULL DEFAULT 3,
+                questions_version INTEGER NOT NULL DEFAULT 0
             );
             CREATE TABLE IF NOT EXISTS questions(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -42,114 +146,647 @@ async def init():
                 current_q_index INTEGER DEFAULT 0,
                 PRIMARY KEY (user_id, chat_id)
             );
+            CREATE INDEX IF NOT EXISTS idx_user_group_state_status
+                ON user_group_state(user_id, status);
+            CREATE INDEX IF NOT EXISTS idx_user_group_state_chat
+                ON user_group_state(chat_id, status);
+            CREATE INDEX IF NOT EXISTS idx_questions_chat
+                ON questions(chat_id, id);
+            CREATE INDEX IF NOT EXISTS idx_group_admins_user
+                ON group_admins(user_id, chat_id);
+            CREATE TABLE IF NOT EXISTS scheduled_deletions(
+                chat_id INTEGER,
+                message_id INTEGER,
+                due_at REAL NOT NULL,
+                shard INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (chat_id, message_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_scheduled_deletions_due
+                ON scheduled_deletions(due_at);
+            CREATE INDEX IF NOT EXISTS idx_answers_log_chat
+                ON answers_log(chat_id, id);
+            CREATE TABLE IF NOT EXISTS answer_stats(
+                chat_id INTEGER,
+                day TEXT,
+                question TEXT,
+                total INTEGER NOT NULL DEFAULT 0,
+                correct INTEGER NOT NULL DEFAULT 0,
+                wrong INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (chat_id, day, question)
+            );
+            CREATE TABLE IF NOT EXISTS fsm_state(
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_fsm_state_updated
+                ON fsm_state(updated_at);
+            CREATE TABLE IF NOT EXISTS archived_stats(
+                chat_id INTEGER,
+                day TEXT,
+                question TEXT,
+                total INTEGER NOT NULL DEFAULT 0,
+                correct INTEGER NOT NULL DEFAULT 0,
+                wrong INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (chat_id, day, question)
+            );
+            CREATE TABLE IF NOT EXISTS counters(
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            );
         """)
+        # Миграции — под блокировкой записи: воркеры workers.py запускаются
+        # одновременно, и без неё два процесса видят, что колонки нет, и оба
+        # пытаются её добавить. Остальные ждут commit() в пределах busy_timeout.
+        await db.execute("BEGIN IMMEDIATE")
+        await _add_column(db, "groups", "questions_version", "INTEGER NOT NULL DEFAULT 0")
+        await _add_column(db, "groups", "log_retention_days", "INTEGER")
+        await _add_column(db, "groups", "log_max_rows", "INTEGER")
+        await _add_column(db, "groups", "verify_timeout_sec", "INTEGER")
+        # бот работает только в группах с enabled=1
+        if await _add_column(db, "groups", "enabled", "INTEGER NOT NULL DEFAULT 1") and GROUPS:
+            # раньше список групп задавался только через GROUPS
+            await db.execute(
+                f"UPDATE groups SET enabled = chat_id IN ({','.join('?' * len(GROUPS))})", GROUPS
+            )
+        await _add_column(db, "user_group_state", "deadline", "REAL")
+        # воркер, который запланировал удаление и выполнит его
+        await _add_column(db, "scheduled_deletions", "shard", "INTEGER NOT NULL DEFAULT 0")
+        await _add_column(db, "questions", "accepted", "TEXT")
+        # 1 — бот ограничил пользователя и ещё не снял ограничение
+        await _add_column(db, "user_group_state", "restricted", "INTEGER NOT NULL DEFAULT 0")
+        # когда началась и чем закончилась проверка — для аналитики в админке
+        await _add_column(db, "user_group_state", "joined_at", "REAL")
+        await _add_column(db, "user_group_state", "finished_at", "REAL")
+        # когда группа стала активной (вступление или /start) — см. get_pending_chat
+        if await _add_column(db, "user_group_state", "activated_at", "REAL"):
+            await db.execute("UPDATE user_group_state SET activated_at=joined_at")
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_user_group_state_unreleased "
+            "ON user_group_state(chat_id) WHERE status='verified' AND restricted=1"
+        )
+        # неверные ответы по вопросу для аналитики админки (load_wrong_answers):
+        # индекс покрывает запрос, и лог группы целиком не читается
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_answers_log_wrong "
+            "ON answers_log(chat_id, question, given_answer, is_correct) WHERE is_correct=0"
+        )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_user_group_state_pending "
+            "ON user_group_state(user_id, activated_at) WHERE status='not_verified'"
+        )
+        # индекс только по ожидающим: проверенные и забаненные в нём не копятся
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_user_group_state_deadline "
+            "ON user_group_state(deadline) WHERE status='not_verified'"
+        )
+        # GROUPS из .env — только начальный список: новые группы регистрируются
+        # сами, когда бота делают админом (register_group)
+        cur = await db.executemany(
+            "INSERT OR IGNORE INTO groups(chat_id, title, max_attempts) VALUES(?,?,?)",
+            [(chat_id, str(chat_id), DEFAULT_ATTEMPTS) for chat_id in GROUPS],
+        )
+        if cur.rowcount > 0:
+            await _bump_counter(db, "groups")
         await db.commit()
+        await _compile_answers(db, only_missing=True)
+        # база старше answer_stats: один раз собираем сводку из лога
+        cur = await db.execute(
+            "SELECT EXISTS(SELECT 1 FROM answers_log) AND NOT EXISTS(SELECT 1 FROM answer_stats)"
+        )
+        if (await cur.fetchone())[0]:
+            await _rebuild_stats(db)
+
+
+# миграция для баз, созданных до появления колонки; True — колонка добавлена
+async def _add_column(db, table: str, column: str, decl: str):
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in await cur.fetchall()}:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        return True
+    return False
+
+
+async def _bump_counter(db, name: str):
+    await db.execute(
+        "INSERT INTO counters(name, value) VALUES(?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+        (name,),
+    )
+
+
+async def close():
+    global _pool, _log_writer, _active_groups
+    if _log_writer is not None:
+        writer, _log_writer = _log_writer, None
+        await writer.stop()
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+    # после закрытия база может измениться, кэши больше не верны
+    _pending.clear()
+    _questions.clear()
+    _admins.clear()
+    _active_groups = None
 
 
 # ---------- группы ----------
-async def ensure_group(chat_id: int, title: str | None = None):
-    title = title or str(chat_id)
-    async with aiosqlite.connect(DB) as db:
+# (counters.groups, время проверки, chat_id включённых групп). Проверка
+# «работает ли бот в этой группе» — поиск в множестве; счётчик сверяется не
+# чаще REGISTRY_RECHECK_SEC, так что группа, подключённая в другом процессе
+# (воркере или админке), начинает работать без перезапуска.
+_active_groups: tuple[int, float, frozenset[int]] | None = None
+
+
+@_timed
+async def active_groups() -> frozenset[int]:
+    global _active_groups
+    cached = _active_groups
+    now = time.monotonic()
+    if cached and now - cached[1] < REGISTRY_RECHECK_SEC:
+        return cached[2]
+    async with connection() as db:
+        cur = await db.execute("SELECT value FROM counters WHERE name='groups'")
+        row = await cur.fetchone()
+        version = row[0] if row else 0
+        if cached and cached[0] == version:
+            _active_groups = (version, now, cached[2])
+            return cached[2]
+        cur = await db.execute("SELECT chat_id FROM groups WHERE enabled=1")
+        groups = frozenset(row[0] for row in await cur.fetchall())
+    _active_groups = (version, now, groups)
+    return groups
+
+
+async def is_active_group(chat_id: int) -> bool:
+    return chat_id in await active_groups()
+
+
+@_timed
+async def register_group(chat_id: int, title: str | None = None):
+    global _active_groups
+    async with connection() as db:
         await db.execute(
-            "INSERT OR IGNORE INTO groups(chat_id, title, max_attempts) VALUES(?,?,?)",
-            (chat_id, title, int(os.getenv("DEFAULT_ATTEMPTS", 3))),
+            """
+            INSERT INTO groups(chat_id, title, max_attempts, enabled) VALUES(?,?,?,1)
+            ON CONFLICT(chat_id) DO UPDATE SET enabled=1, title=COALESCE(?, title)
+            """,
+            (chat_id, title or str(chat_id), DEFAULT_ATTEMPTS, title),
         )
+        await _bump_counter(db, "groups")
         await db.commit()
+    _active_groups = None
 
 
+@_timed
+async def unregister_group(chat_id: int):
+    # вопросы, статистика и настройки остаются — группу можно включить снова
+    global _active_groups
+    async with connection() as db:
+        cur = await db.execute("UPDATE groups SET enabled=0 WHERE chat_id=? AND enabled=1", (chat_id,))
+        if cur.rowcount:
+            await _bump_counter(db, "groups")
+        await db.commit()
+    _active_groups = None
+
+
+@_timed
 async def set_group_title(chat_id: int, title: str):
-    async with aiosqlite.connect(DB) as db:
+    async with connection() as db:
         await db.execute("UPDATE groups SET title=? WHERE chat_id=?", (title, chat_id))
         await db.commit()
 
 
+@_timed
 async def get_groups_info():
-    async with aiosqlite.connect(DB) as db:
+    async with connection() as db:
         cur = await db.execute("SELECT chat_id, title FROM groups")
         return await cur.fetchall()
 
 
+@_timed
 async def set_max_attempts(chat_id: int, n: int):
-    async with aiosqlite.connect(DB) as db:
+    async with connection() as db:
         await db.execute("UPDATE groups SET max_attempts=? WHERE chat_id=?", (n, chat_id))
         await db.commit()
 
 
+@_timed
 async def get_max_attempts(chat_id: int):
-    async with aiosqlite.connect(DB) as db:
+    async with connection() as db:
         cur = await db.execute("SELECT max_attempts FROM groups WHERE chat_id=?", (chat_id,))
         row = await cur.fetchone()
-    return row[0] if row else int(os.getenv("DEFAULT_ATTEMPTS", 3))
+    return row[0] if row else DEFAULT_ATTEMPTS
+
+
+@_timed
+async def set_verify_timeout(chat_id: int, seconds: int | None):
+    async with connection() as db:
+        await db.execute("UPDATE groups SET verify_timeout_sec=? WHERE chat_id=?", (seconds, chat_id))
+        await db.commit()
+
+
+# ---------- постраничные списки ----------
+class Page(NamedTuple):
+    rows: list
+    before: int | None  # ключ для кнопки «назад», None — это первая страница
+    after: int | None  # ключ для кнопки «далее», None — это последняя страница
+
+
+async def _page(sql: str, params: tuple, key: str, cursor: int | None, backward: bool, limit: int):
+    # Keyset-пагинация: страница выбирается условием по ключу, а не OFFSET,
+    # поэтому каждый экран — один запрос по индексу на limit + 1 строк.
+    # Первый столбец выборки — сам ключ.
+    if cursor is not None:
+        sql += f" AND {key} {'<' if backward else '>'} ?"
+        params += (cursor,)
+    sql += f" ORDER BY {key} {'DESC' if backward else ''} LIMIT ?"
+    async with connection() as db:
+        cur = await db.execute(sql, params + (limit + 1,))
+        rows = await cur.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+        has_before, has_after = more, True
+    else:
+        has_before, has_after = cursor is not None, more
+    if not rows:
+        return Page([], None, None)
+    return Page(rows, rows[0][0] if has_before else None, rows[-1][0] if has_after else None)
+
+
+@_timed
+async def get_groups_page(
+    cursor: int | None = None, backward: bool = False, limit: int = 10, admin_id: int | None = None
+):
+    # все группы или только те, где admin_id — админ
+    if admin_id is None:
+        return await _page("SELECT chat_id, title FROM groups WHERE enabled=1", (), "chat_id", cursor, backward, limit)
+    return await _page(
+        "SELECT a.chat_id, g.title FROM group_admins a "
+        "JOIN groups g ON g.chat_id = a.chat_id WHERE a.user_id=? AND g.enabled=1",
+        (admin_id,),
+        "a.chat_id",
+        cursor,
+        backward,
+        limit,
+    )
+
+
+@_timed
+async def get_questions_page(chat_id: int, cursor: int | None = None, backward: bool = False, limit: int = 10):
+    return await _page(
+        "SELECT id, question, answer FROM questions WHERE chat_id=?",
+        (chat_id,),
+        "id",
+        cursor,
+        backward,
+        limit,
+    )
 
 
 # ---------- вопросы ----------
+# chat_id -> (questions_version, время проверки версии, вопросы). Правки из бота
+# сбрасывают запись сразу, правки из админки (другой процесс) видны по счётчику
+# groups.questions_version, который сверяется не чаще QUESTIONS_RECHECK_SEC.
+_questions: dict[int, tuple[int, float, list]] = {}
+
+
+async def _bump_questions_version(db, chat_id: int):
+    # вопросы для ещё не подключённой группы сохраняются в выключенной строке;
+    # включает группу только register_group
+    await db.execute(
+        """
+        INSERT INTO groups(chat_id, title, max_attempts, enabled) VALUES(?,?,?,0)
+        ON CONFLICT(chat_id) DO UPDATE SET questions_version = questions_version + 1
+        """,
+        (chat_id, str(chat_id), DEFAULT_ATTEMPTS),
+    )
+
+
+async def _compile_answers(db, only_missing: bool):
+    # questions.accepted для вопросов, сохранённых до его появления
+    # (или после смены правил нормализации)
+    sql = "SELECT id, answer FROM questions" + (" WHERE accepted IS NULL" if only_missing else "")
+    cur = await db.execute(sql)
+    rows = [(matching.compile_answer(a), qid) for qid, a in await cur.fetchall()]
+    if rows:
+        await db.executemany("UPDATE questions SET accepted=? WHERE id=?", rows)
+        await db.execute("UPDATE groups SET questions_version = questions_version + 1")
+        await db.commit()
+        _questions.clear()
+    return len(rows)
+
+
+@_timed
+async def compile_answers():
+    async with connection() as db:
+        return await _compile_answers(db, only_missing=False)
+
+
+@_timed
 async def add_question(chat_id: int, q: str, a: str):
-    async with aiosqlite.connect(DB) as db:
+    async with connection() as db:
         await db.execute(
-            "INSERT INTO questions(chat_id, question, answer) VALUES(?,?,?)",
-            (chat_id, q, a),
+            "INSERT INTO questions(chat_id, question, answer, accepted) VALUES(?,?,?,?)",
+            (chat_id, q, a, matching.compile_answer(a)),
         )
+        await _bump_questions_version(db, chat_id)
         await db.commit()
+    _questions.pop(chat_id, None)
 
 
+@_timed
 async def delete_question(qid: int):
-    async with aiosqlite.connect(DB) as db:
+    async with connection() as db:
+        cur = await db.execute("SELECT chat_id FROM questions WHERE id=?", (qid,))
+        row = await cur.fetchone()
+        if row is None:
+            return
         await db.execute("DELETE FROM questions WHERE id=?", (qid,))
+        await _bump_questions_version(db, row[0])
+        await db.commit()
+    _questions.pop(row[0], None)
+
+
+@_timed
+async def import_questions(chat_ids: list[int], pairs: list[tuple[str, str]], replace: bool = False):
+    # один набор вопросов в несколько групп одной транзакцией
+    async with connection() as db:
+        if replace:
+            await db.executemany("DELETE FROM questions WHERE chat_id=?", [(c,) for c in chat_ids])
+        compiled = [(q, a, matching.compile_answer(a)) for q, a in pairs]
+        await db.executemany(
+            "INSERT INTO questions(chat_id, question, answer, accepted) VALUES(?,?,?,?)",
+            [(c, *row) for c in chat_ids for row in compiled],
+        )
+        for chat_id in chat_ids:
+            await _bump_questions_version(db, chat_id)
+        await db.commit()
+    for chat_id in chat_ids:
+        _questions.pop(chat_id, None)
+
+
+@_timed
+async def copy_questions(src_chat_id: int, chat_ids: list[int], replace: bool = False):
+    # вопросы src_chat_id копируются во все chat_ids одним INSERT ... SELECT
+    chat_ids = [c for c in chat_ids if c != src_chat_id]
+    async with connection() as db:
+        if replace:
+            await db.executemany("DELETE FROM questions WHERE chat_id=?", [(c,) for c in chat_ids])
+        cur = await db.execute(
+            """
+            INSERT INTO questions(chat_id, question, answer, accepted)
+            SELECT t.value, q.question, q.answer, q.accepted
+            FROM json_each(?) t CROSS JOIN questions q
+            WHERE q.chat_id=?
+            ORDER BY t.key, q.id
+            """,
+            (json.dumps(chat_ids), src_chat_id),
+        )
+        for chat_id in chat_ids:
+            await _bump_questions_version(db, chat_id)
         await db.commit()
+    for chat_id in chat_ids:
+        _questions.pop(chat_id, None)
+    return cur.rowcount
 
 
+@_timed
 async def get_questions(chat_id: int):
-    async with aiosqlite.connect(DB) as db:
+    cached = _questions.get(chat_id)
+    now = time.monotonic()
+    if cached and now - cached[1] < QUESTIONS_RECHECK_SEC:
+        return cached[2]
+    async with connection() as db:
+        cur = await db.execute("SELECT questions_version FROM groups WHERE chat_id=?", (chat_id,))
+        row = await cur.fetchone()
+        version = row[0] if row else 0
+        if cached and cached[0] == version:
+            _questions[chat_id] = (version, now, cached[2])
+            return cached[2]
         cur = await db.execute(
-            "SELECT id, question, answer FROM questions WHERE chat_id=? ORDER BY id", (chat_id,)
+            "SELECT id, question, answer, accepted FROM questions WHERE chat_id=? ORDER BY id",
+            (chat_id,),
         )
-        return await cur.fetchall()
+        # (id, вопрос, ответ, множество принятых вариантов)
+        rows = [
+            (qid, q, a, matching.load_accepted(accepted, a))
+            for qid, q, a, accepted in await cur.fetchall()
+        ]
+    _questions[chat_id] = (version, now, rows)
+    return rows
 
 
 # ---------- админы ----------
+@_timed
 async def add_admin(chat_id: int, user_id: int):
-    async with aiosqlite.connect(DB) as db:
+    async with connection() as db:
         await db.execute(
             "INSERT OR IGNORE INTO group_admins(chat_id, user_id) VALUES(?,?)",
             (chat_id, user_id),
         )
         await db.commit()
+    _admins.pop(chat_id, None)
+
 
+# chat_id -> (время загрузки, админы чата). Правки из бота сбрасывают запись
+# сразу, правки из админки подхватываются по истечении ADMIN_CACHE_TTL.
+_admins: dict[int, tuple[float, frozenset[int]]] = {}
 
+
+@_timed
 async def is_admin(chat_id: int, user_id: int):
-    if user_id in [int(x) for x in os.getenv("SUPER_ADMINS", "").split(",") if x]:
+    if user_id in SUPER_ADMINS:
         return True
-    async with aiosqlite.connect(DB) as db:
-        cur = await db.execute(
-            "SELECT 1 FROM group_admins WHERE chat_id=? AND user_id=?", (chat_id, user_id)
-        )
-        return bool(await cur.fetchone())
+    cached = _admins.get(chat_id)
+    now = time.monotonic()
+    if cached is None or now - cached[0] >= ADMIN_CACHE_TTL:
+        async with connection() as db:
+            cur = await db.execute("SELECT user_id FROM group_admins WHERE chat_id=?", (chat_id,))
+            cached = _admins[chat_id] = (now, frozenset(row[0] for row in await cur.fetchall()))
+    return user_id in cached[1]
 
 
+@_timed
 async def get_group_admins(chat_id: int):
-    async with aiosqlite.connect(DB) as db:
+    async with connection() as db:
         cur = await db.execute("SELECT user_id FROM group_admins WHERE chat_id=?", (chat_id,))
         return [row[0] for row in await cur.fetchall()]
 
 
 # ---------- логи ----------
+# Ответы пишутся в answers_log фоновой задачей: обработчик только кладёт строку
+# в очередь, а запись идёт пачками через executemany раз в LOG_BATCH_SIZE строк
+# или LOG_FLUSH_MS миллисекунд. При переполнении очереди обработчик либо ждёт
+# (block), либо строка отбрасывается и учитывается в dropped (drop).
+class LogWriter:
+    def __init__(self, batch_size: int, flush_ms: int, queue_size: int, policy: str = "block"):
+        self.batch_size = max(1, batch_size)
+        self.flush_sec = flush_ms / 1000
+        self.policy = policy
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.written = 0
+        self.dropped = 0
+        self._batch_ready = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def put(self, row: tuple):
+        try:
+            self.queue.put_nowait(row)
+        except asyncio.QueueFull:
+            if self.policy == "drop":
+                self.dropped += 1
+                return
+            await self.queue.put(row)
+        if self.queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    async def stop(self):
+        # None — маркер конца: всё, что лежит до него, будет записано
+        await self.queue.put(None)
+        self._batch_ready.set()
+        await self._task
+
+    async def _run(self):
+        while True:
+            row = await self.queue.get()
+            if row is None:
+                return
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            batch, stopping = [row], False
+            while len(batch) < self.batch_size and not self.queue.empty():
+                row = self.queue.get_nowait()
+                if row is None:
+                    stopping = True
+                    break
+                batch.append(row)
+            await self._write(batch)
+            if stopping:
+                return
+
+    async def _write(self, batch: list[tuple]):
+        started = time.perf_counter()
+        try:
+            async with connection() as db:
+                await db.executemany(
+                    """
+                    INSERT INTO answers_log(chat_id,user_id,username,question,given_answer,is_correct)
+                    VALUES(?,?,?,?,?,?)
+                    """,
+                    batch,
+                )
+                await _add_to_stats(db, batch)
+                await db.commit()
+            self.written += len(batch)
+        except Exception:
+            log.exception("Не удалось записать %d строк в answers_log", len(batch))
+        finally:
+            metrics.DB_SECONDS.observe("log_flush", time.perf_counter() - started)
+
+
+def log_queue_depth() -> int:
+    return _log_writer.queue.qsize() if _log_writer is not None else 0
+
+
+@_timed
 async def log_answer(chat_id, user_id, username, question, given, ok):
-    async with aiosqlite.connect(DB) as db:
+    await _log_writer.put((chat_id, user_id, username, question, given, int(ok)))
+
+
+# ---------- отложенное удаление сообщений ----------
+@_timed
+async def add_scheduled_deletion(chat_id: int, message_id: int, due_at: float, shard: int = 0):
+    async with connection() as db:
         await db.execute(
-            """
-            INSERT INTO answers_log(chat_id,user_id,username,question,given_answer,is_correct)
-            VALUES(?,?,?,?,?,?)
-            """,
-            (chat_id, user_id, username, question, given, int(ok)),
+            "INSERT OR REPLACE INTO scheduled_deletions(chat_id, message_id, due_at, shard) VALUES(?,?,?,?)",
+            (chat_id, message_id, due_at, shard),
+        )
+        await db.commit()
+
+
+@_timed
+async def get_scheduled_deletions(shard: int = 0, shard_count: int = 1):
+    # задания воркера shard; если воркеров стало меньше, задания лишних
+    # делятся между оставшимися по номеру
+    async with connection() as db:
+        cur = await db.execute(
+            "SELECT due_at, chat_id, message_id FROM scheduled_deletions WHERE shard % ? = ?",
+            (max(1, shard_count), shard),
+        )
+        return await cur.fetchall()
+
+
+@_timed
+async def remove_scheduled_deletions(items: list[tuple[int, int]]):
+    async with connection() as db:
+        await db.executemany(
+            "DELETE FROM scheduled_deletions WHERE chat_id=? AND message_id=?", items
         )
         await db.commit()
 
 
 # ---------- статистика ----------
+# answer_stats — сводка по (чат, день, вопрос), которая пополняется вместе с
+# записью лога. get_stats читает её, а не пересчитывает весь answers_log.
+async def _add_to_stats(db, batch: list[tuple]):
+    counts: dict[tuple[int, str], list[int]] = {}
+    for chat_id, _, _, question, _, ok in batch:
+        c = counts.setdefault((chat_id, question), [0, 0])
+        c[0] += 1
+        c[1] += ok
+    await db.executemany(
+        """
+        INSERT INTO answer_stats(chat_id, day, question, total, correct, wrong)
+        VALUES(?, date('now'), ?, ?, ?, ?)
+        ON CONFLICT(chat_id, day, question) DO UPDATE SET
+            total = total + excluded.total,
+            correct = correct + excluded.correct,
+            wrong = wrong + excluded.wrong
+        """,
+        [(chat_id, q, total, ok, total - ok) for (chat_id, q), (total, ok) in counts.items()],
+    )
+
+
+async def _rebuild_stats(db):
+    # строки, уже ушедшие в архив, учитываются по archived_stats
+    await db.execute("DELETE FROM answer_stats")
+    await db.execute(
+        """
+        INSERT INTO answer_stats(chat_id, day, question, total, correct, wrong)
+        SELECT chat_id, day, question, SUM(total), SUM(correct), SUM(wrong) FROM (
+            SELECT chat_id, date(ts) AS day, question, COUNT(*) AS total,
+                   SUM(is_correct) AS correct, SUM(NOT is_correct) AS wrong
+            FROM answers_log GROUP BY chat_id, date(ts), question
+            UNION ALL
+            SELECT chat_id, day, question, total, correct, wrong FROM archived_stats
+        )
+        GROUP BY chat_id, day, question
+        """
+    )
+    await db.commit()
+
+
+@_timed
+async def rebuild_stats():
+    async with connection() as db:
+        await _rebuild_stats(db)
+
+
+@_timed
 async def get_stats(chat_id: int):
-    async with aiosqlite.connect(DB) as db:
+    async with connection() as db:
         cur = await db.execute(
-            "SELECT COUNT(*), SUM(is_correct), SUM(NOT is_correct) FROM answers_log WHERE chat_id=?",
+            "SELECT SUM(total), SUM(correct), SUM(wrong) FROM answer_stats WHERE chat_id=?",
             (chat_id,),
         )
         row = await cur.fetchone()
@@ -164,21 +801,308 @@ async def get_stats(chat_id: int):
     return total, ok, bad, last_rows
 
 
+# ---------- хранение и архив лога ----------
+@_timed
+async def set_log_retention(chat_id: int, days: int | None, max_rows: int | None):
+    async with connection() as db:
+        await db.execute(
+            "UPDATE groups SET log_retention_days=?, log_max_rows=? WHERE chat_id=?",
+            (days, max_rows, chat_id),
+        )
+        await db.commit()
+
+
+@_timed
+async def get_log_retention(chat_id: int):
+    # (дней, строк) с учётом значений по умолчанию, 0 — без ограничения
+    async with connection() as db:
+        cur = await db.execute(
+            "SELECT log_retention_days, log_max_rows FROM groups WHERE chat_id=?", (chat_id,)
+        )
+        row = await cur.fetchone()
+    days, max_rows = row if row else (None, None)
+    return (
+        LOG_RETENTION_DAYS if days is None else days,
+        LOG_MAX_ROWS if max_rows is None else max_rows,
+    )
+
+
+@_timed
+async def get_logged_chats():
+    async with connection() as db:
+        cur = await db.execute("SELECT DISTINCT chat_id FROM answers_log")
+        return [row[0] for row in await cur.fetchall()]
+
+
+@_timed
+async def get_archivable(chat_id: int, days: int, max_rows: int, limit: int):
+    # самые старые строки чата, которые старше days дней или не входят
+    # в последние max_rows
+    async with connection() as db:
+        cutoff_id = -1
+        if max_rows:
+            cur = await db.execute(
+                "SELECT id FROM answers_log WHERE chat_id=? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (chat_id, max_rows),
+            )
+            row = await cur.fetchone()
+            cutoff_id = row[0] if row else -1
+        cur = await db.execute(
+            """
+            SELECT id, chat_id, user_id, username, question, given_answer, is_correct, ts
+            FROM answers_log
+            WHERE chat_id=? AND (id <= ? OR (? > 0 AND ts < datetime('now', '-' || ? || ' days')))
+            ORDER BY id LIMIT ?
+            """,
+            (chat_id, cutoff_id, days, days, limit),
+        )
+        return await cur.fetchall()
+
+
+@_timed
+async def delete_archived(rows: list[tuple]):
+    # короткая транзакция на пачку: строки уходят из лога, а их счётчики —
+    # в archived_stats, чтобы rebuild_stats не потерял архивные итоги
+    counts: dict[tuple[int, str, str], list[int]] = {}
+    for _, chat_id, _, _, question, _, ok, ts in rows:
+        c = counts.setdefault((chat_id, str(ts)[:10], question), [0, 0])
+        c[0] += 1
+        c[1] += ok
+    async with connection() as db:
+        await db.executemany("DELETE FROM answers_log WHERE id=?", [(row[0],) for row in rows])
+        await db.executemany(
+            """
+            INSERT INTO archived_stats(chat_id, day, question, total, correct, wrong)
+            VALUES(?,?,?,?,?,?)
+            ON CONFLICT(chat_id, day, question) DO UPDATE SET
+                total = total + excluded.total,
+                correct = correct + excluded.correct,
+                wrong = wrong + excluded.wrong
+            """,
+            [(c, day, q, total, ok, total - ok) for (c, day, q), (total, ok) in counts.items()],
+        )
+        await db.commit()
+
+
+@_timed
+async def get_archived_stats(chat_id: int):
+    async with connection() as db:
+        cur = await db.execute(
+            """
+            SELECT substr(day, 1, 7) AS month, SUM(total), SUM(correct), SUM(wrong)
+            FROM archived_stats WHERE chat_id=? GROUP BY month ORDER BY month
+            """,
+            (chat_id,),
+        )
+        return await cur.fetchall()
+
+
+@_timed
+async def checkpoint():
+    async with connection() as db:
+        await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+@_timed
+async def vacuum():
+    async with connection() as db:
+        await db.execute("VACUUM")
+
+
+# ---------- состояния FSM ----------
+@_timed
+async def load_fsm(key: str):
+    async with connection() as db:
+        cur = await db.execute("SELECT state, data, updated_at FROM fsm_state WHERE key=?", (key,))
+        return await cur.fetchone()
+
+
+@_timed
+async def save_fsm(rows: list[tuple[str, str | None, str, float]], deleted: list[str]):
+    async with connection() as db:
+        await db.executemany(
+            "INSERT OR REPLACE INTO fsm_state(key, state, data, updated_at) VALUES(?,?,?,?)", rows
+        )
+        await db.executemany("DELETE FROM fsm_state WHERE key=?", [(k,) for k in deleted])
+        await db.commit()
+
+
+@_timed
+async def expire_fsm(before: float):
+    async with connection() as db:
+        cur = await db.execute("DELETE FROM fsm_state WHERE updated_at < ?", (before,))
+        await db.commit()
+    return cur.rowcount
+
+
 # ---------- пользователи ----------
+# user_id -> группы, где пользователь ещё не прошёл проверку, в порядке
+# начала проверки (последняя — активная). Пустой dict значит «ожидающих нет».
+_pending: dict[int, dict[int, None]] = {}
+
+
+def _track_pending(user_id: int, chat_id: int, status: str):
+    chats = _pending.get(user_id)
+    if chats is None:
+        return
+    chats.pop(chat_id, None)
+    if status == "not_verified":
+        chats[chat_id] = None
+
+
+@_timed
+async def get_pending_chat(user_id: int):
+    # Группа, в которой пользователь проходит проверку сейчас. Если ожидающих
+    # групп несколько, берётся та, где проверка начата (или /start нажат) последней.
+    chats = _pending.get(user_id)
+    if chats is None:
+        async with connection() as db:
+            cur = await db.execute(
+                "SELECT chat_id FROM user_group_state "
+                "WHERE user_id=? AND status='not_verified' ORDER BY activated_at, rowid",
+                (user_id,),
+            )
+            rows = await cur.fetchall()
+        if len(_pending) >= PENDING_CACHE_SIZE:
+            _pending.pop(next(iter(_pending)))
+        chats = _pending.setdefault(user_id, dict.fromkeys(row[0] for row in rows))
+    return next(reversed(chats), None)
+
+
+@_timed
 async def upsert_user_state(user_id: int, chat_id: int, status="not_verified", attempts=0, current_q_index=0):
-    async with aiosqlite.connect(DB) as db:
-        await db.execute(
+    # /start: новая строка или уже ожидающая проверки группа становится
+    # активной — activated_at запоминается в базе, чтобы порядок не терялся
+    # после перезапуска и у других воркеров
+    async with connection() as db:
+        cur = await db.execute(
+            """
+            INSERT INTO user_group_state(user_id, chat_id, status, attempts, current_q_index, activated_at)
+            VALUES(?,?,?,?,?,?)
+            ON CONFLICT(user_id, chat_id) DO UPDATE SET activated_at=excluded.activated_at
+            WHERE status='not_verified'
+            RETURNING status
+            """,
+            (user_id, chat_id, status, attempts, current_q_index, time.time()),
+        )
+        row = await cur.fetchone()
+        await db.commit()
+    if row is not None:
+        _track_pending(user_id, chat_id, row[0])
+
+
+@_timed
+async def start_verification(user_id: int, chat_id: int) -> bool:
+    # Вступление в группу: проверка начинается заново и получает срок
+    # deadline = сейчас + verify_timeout_sec группы (0 — без срока), а строка
+    # помечается restricted — сразу после неё бот ограничивает пользователя.
+    # Уже проверенных и забаненных повторное вступление не трогает — тогда
+    # возвращается False.
+    now = time.time()
+    async with connection() as db:
+        cur = await db.execute(
+            """
+            INSERT INTO user_group_state(
+                user_id, chat_id, status, attempts, current_q_index, deadline, restricted, joined_at,
+                activated_at
+            )
+            SELECT ?, ?, 'not_verified', 0, 0, CASE WHEN t > 0 THEN ? + t END, 1, ?, ?
+            FROM (SELECT COALESCE((SELECT verify_timeout_sec FROM groups WHERE chat_id=?), ?) AS t)
+            WHERE true
+            ON CONFLICT(user_id, chat_id) DO UPDATE SET
+                attempts=0, current_q_index=0, deadline=excluded.deadline, restricted=1,
+                joined_at=excluded.joined_at, activated_at=excluded.activated_at
+            WHERE status='not_verified'
+            RETURNING status
+            """,
+            (user_id, chat_id, now, now, now, chat_id, VERIFY_TIMEOUT_SEC),
+        )
+        started = await cur.fetchone() is not None
+        await db.commit()
+    if started:
+        _track_pending(user_id, chat_id, "not_verified")
+    return started
+
+
+@_timed
+async def get_expired(before: float, limit: int):
+    async with connection() as db:
+        cur = await db.execute(
+            "SELECT user_id, chat_id FROM user_group_state "
+            "WHERE status='not_verified' AND deadline <= ? ORDER BY deadline LIMIT ?",
+            (before, limit),
+        )
+        return await cur.fetchall()
+
+
+@_timed
+async def finish_expired(items: list[tuple[int, int]], banned: bool):
+    # выгнанный может вернуться и начать заново, поэтому его строка
+    # удаляется; забаненный остаётся со статусом banned
+    async with connection() as db:
+        if banned:
+            await db.executemany(
+                "UPDATE user_group_state SET status='banned', deadline=NULL, finished_at=? "
+                "WHERE user_id=? AND chat_id=? AND status='not_verified'",
+                [(time.time(), user_id, chat_id) for user_id, chat_id in items],
+            )
+        else:
+            await db.executemany(
+                "DELETE FROM user_group_state WHERE user_id=? AND chat_id=? AND status='not_verified'",
+                items,
+            )
+        await db.commit()
+    for user_id, chat_id in items:
+        _track_pending(user_id, chat_id, "banned")
+
+
+@_timed
+async def mark_unrestricted(items: list[tuple[int, int]]):
+    async with connection() as db:
+        await db.executemany(
+            "UPDATE user_group_state SET restricted=0 WHERE user_id=? AND chat_id=?", items
+        )
+        await db.commit()
+
+
+@_timed
+async def get_unreleased(limit: int):
+    # прошли проверку, но ограничение не снято (бот упал между ответом
+    # и вызовом restrictChatMember)
+    async with connection() as db:
+        cur = await db.execute(
+            "SELECT user_id, chat_id FROM user_group_state "
+            "WHERE status='verified' AND restricted=1 LIMIT ?",
+            (limit,),
+        )
+        return await cur.fetchall()
+
+
+@_timed
+async def requeue_pending():
+    # ожидающим без срока (вступили до появления deadline) срок
+    # назначается от текущего момента, дальше ими займётся ExpirySweeper
+    async with connection() as db:
+        cur = await db.execute(
             """
-            INSERT OR IGNORE INTO user_group_state(user_id, chat_id, status, attempts, current_q_index)
-            VALUES(?,?,?,?,?)
+            UPDATE user_group_state SET deadline = ? + (
+                SELECT COALESCE(MAX(verify_timeout_sec), ?) FROM groups
+                WHERE groups.chat_id = user_group_state.chat_id
+            )
+            WHERE status='not_verified' AND deadline IS NULL AND (
+                SELECT COALESCE(MAX(verify_timeout_sec), ?) FROM groups
+                WHERE groups.chat_id = user_group_state.chat_id
+            ) > 0
             """,
-            (user_id, chat_id, status, attempts, current_q_index),
+            (time.time(), VERIFY_TIMEOUT_SEC, VERIFY_TIMEOUT_SEC),
         )
         await db.commit()
+    return cur.rowcount
 
 
+@_timed
 async def get_user_state(user_id: int, chat_id: int):
-    async with aiosqlite.connect(DB) as db:
+    async with connection() as db:
         cur = await db.execute(
             "SELECT status, attempts, current_q_index FROM user_group_state WHERE user_id=? AND chat_id=?",
             (user_id, chat_id),
@@ -186,11 +1110,120 @@ async def get_user_state(user_id: int, chat_id: int):
         return await cur.fetchone()
 
 
+@_timed
 async def update_user_state(user_id: int, chat_id: int, **kwargs):
     set_part = ", ".join([f"{k}=?" for k in kwargs])
     values = tuple(kwargs.values()) + (user_id, chat_id)
-    async with aiosqlite.connect(DB) as db:
+    async with connection() as db:
         await db.execute(
             f"UPDATE user_group_state SET {set_part} WHERE user_id=? AND chat_id=?", values
         )
-        await db.commit()
\ No newline at end of file
+        await db.commit()
+    if "status" in kwargs:
+        _track_pending(user_id, chat_id, kwargs["status"])
+
+
+# ---------- прогрев кэшей ----------
+@_timed
+async def warm_up():
+    # После перезапуска кэши вопросов, админов, ожидающих проверки и список
+    # подключённых групп заполняются пятью запросами вместо запроса на каждое
+    # первое обращение к группе или пользователю.
+    now = time.monotonic()
+    async with connection() as db:
+        cur = await db.execute("SELECT chat_id, questions_version FROM groups")
+        versions = dict(await cur.fetchall())
+        cur = await db.execute(
+            "SELECT chat_id, id, question, answer, accepted FROM questions ORDER BY chat_id, id"
+        )
+        questions: dict[int, list] = {chat_id: [] for chat_id in versions}
+        for chat_id, qid, q, a, accepted in await cur.fetchall():
+            questions.setdefault(chat_id, []).append((qid, q, a, matching.load_accepted(accepted, a)))
+        cur = await db.execute("SELECT chat_id, user_id FROM group_admins")
+        admins: dict[int, set[int]] = {chat_id: set() for chat_id in versions}
+        for chat_id, user_id in await cur.fetchall():
+            admins.setdefault(chat_id, set()).add(user_id)
+        # по индексу ожидающих: строки одного пользователя идут подряд
+        # в порядке activated_at, как в get_pending_chat
+        cur = await db.execute(
+            "SELECT user_id, chat_id FROM user_group_state "
+            "WHERE status='not_verified' ORDER BY user_id, activated_at, rowid LIMIT ?",
+            (PENDING_CACHE_SIZE + 1,),
+        )
+        rows = await cur.fetchall()
+    pending: dict[int, dict[int, None]] = {}
+    for user_id, chat_id in rows:
+        pending.setdefault(user_id, {})[chat_id] = None
+    if len(rows) > PENDING_CACHE_SIZE:
+        # у последнего пользователя могли попасть не все группы
+        pending.pop(rows[-1][0])
+
+    for chat_id, qs in questions.items():
+        _questions[chat_id] = (versions.get(chat_id, 0), now, qs)
+    for chat_id, ids in admins.items():
+        _admins[chat_id] = (now, frozenset(ids))
+    _pending.update(pending)
+    await active_groups()
+    return {"groups": len(versions), "questions": sum(map(len, questions.values())), "pending": len(pending)}
+
+
+# ---------- ответ на капчу ----------
+class AnswerResult(NamedTuple):
+    outcome: str  # "next", "verified", "wrong" или "banned"
+    next_question: str | None = None
+    attempts_left: int = 0
+
+
+@_timed
+async def process_answer(user_id: int, chat_id: int, username: str, given: str):
+    # Чтение состояния, проверка и переход к следующему шагу — одна транзакция
+    # BEGIN IMMEDIATE, так что два быстрых сообщения подряд обрабатываются
+    # строго по очереди и не съедают лишнюю попытку. Лог уходит в LogWriter.
+    questions = await get_questions(chat_id)
+    async with connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        cur = await db.execute(
+            """
+            SELECT s.status, s.attempts, s.current_q_index, g.max_attempts
+            FROM user_group_state s LEFT JOIN groups g ON g.chat_id = s.chat_id
+            WHERE s.user_id=? AND s.chat_id=?
+            """,
+            (user_id, chat_id),
+        )
+        row = await cur.fetchone()
+        if row is None or row[0] != "not_verified" or row[2] >= len(questions):
+            await db.rollback()
+            if row is None or row[0] != "not_verified":
+                # проверку закончил другой процесс (ExpirySweeper работает
+                # только в первом воркере) — кэш этого воркера устарел
+                _track_pending(user_id, chat_id, row[0] if row else "gone")
+            return None
+        _, attempts, idx, max_attempts = row
+        if max_attempts is None:
+            max_attempts = DEFAULT_ATTEMPTS
+
+        q = questions[idx][1]
+        ok = matching.matches(given, questions[idx][3])
+
+        if ok and idx + 1 < len(questions):
+            status, attempts, idx = "not_verified", 0, idx + 1
+            result = AnswerResult("next", next_question=questions[idx][1])
+        elif ok:
+            status = "verified"
+            result = AnswerResult("verified")
+        else:
+            attempts += 1
+            status = "banned" if attempts >= max_attempts else "not_verified"
+            result = AnswerResult(
+                "banned" if status == "banned" else "wrong",
+                attempts_left=max(max_attempts - attempts, 0),
+            )
+        await db.execute(
+            "UPDATE user_group_state SET status=?, attempts=?, current_q_index=?, finished_at=? "
+            "WHERE user_id=? AND chat_id=?",
+            (status, attempts, idx, None if status == "not_verified" else time.time(), user_id, chat_id),
+        )
+        await db.commit()
+    _track_pending(user_id, chat_id, status)
+    await log_answer(chat_id, user_id, username, q, given, ok)
+    return result
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+import database
+from config import EXPIRE_BATCH, EXPIRE_RATE, EXPIRE_SWEEP_SEC, VERIFY_EXPIRE_ACTION
+from outbound import LOW, PriorityBucket
+
+# бан короче 30 секунд Telegram считает вечным, поэтому «выгнать» —
+# это бан на минуту: один вызов вместо ban + unban
+KICK_FOR = timedelta(minutes=1)
+
+log = logging.getLogger(__name__)
+
+
+# ---------- выгон не прошедших проверку ----------
+# Раз в interval_sec выбирает из user_group_state строки со статусом
+# not_verified и истёкшим deadline (по частичному индексу, пачками по
+# batch_size) и выгоняет или банит этих пользователей. Вызовы идут через
+# собственный bucket с темпом rate, чтобы уборка не съедала лимит Telegram,
+# нужный живым вступлениям. Обработанные строки удаляются (kick) или
+# помечаются banned, так что таблица не растёт с историей.
+class ExpirySweeper:
+    def __init__(
+        self,
+        bot: Bot,
+        action: str = VERIFY_EXPIRE_ACTION,
+        interval_sec: float = EXPIRE_SWEEP_SEC,
+        batch_size: int = EXPIRE_BATCH,
+        rate: float = EXPIRE_RATE,
+    ):
+        self.bot = bot
+        self.ban = action == "ban"
+        self.interval_sec = interval_sec
+        self.batch_size = batch_size
+        self.bucket = PriorityBucket(rate, 1)
+        self.expired = 0
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                log.exception("Не удалось выгнать не прошедших проверку")
+            await asyncio.sleep(self.interval_sec)
+
+    async def sweep(self) -> int:
+        # одна пачка за другой, пока просроченные не кончатся; после временной
+        # ошибки Telegram остаток ждёт следующего прохода
+        done = 0
+        while True:
+            rows = await database.get_expired(time.time(), self.batch_size)
+            closed = []
+            for user_id, chat_id in rows:
+                await self.bucket.acquire(LOW)
+                try:
+                    if self.ban:
+                        await self.bot.ban_chat_member(chat_id, user_id)
+                    else:
+                        await self.bot.ban_chat_member(chat_id, user_id, until_date=KICK_FOR)
+                except (TelegramBadRequest, TelegramForbiddenError) as e:
+                    # уже вышел или у бота нет прав — строку всё равно закрываем
+                    log.info("Не удалось выгнать %s из %s: %s", user_id, chat_id, e)
+                except Exception as e:
+                    # 429 после всех повторов, сеть — строка ждёт следующего прохода
+                    log.warning("%s из %s не выгнан, повторим: %s", user_id, chat_id, e)
+                    continue
+                closed.append((user_id, chat_id))
+            if closed:
+                await database.finish_expired(closed, self.ban)
+                done += len(closed)
+                self.expired += len(closed)
+            if len(rows) < self.batch_size or len(closed) < len(rows):
+                if done:
+                    log.info("Выгнано не прошедших проверку: %d", done)
+                return done
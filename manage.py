@@ -0,0 +1,53 @@
+import argparse
+import asyncio
+
+import database
+import retention
+
+
+async def rebuild_stats(args):
+    await database.rebuild_stats()
+    print("Сводка answer_stats пересобрана из answers_log.")
+
+
+async def archive(args):
+    moved = await retention.archive_all()
+    print(f"В архив перенесено строк: {moved}.")
+
+
+async def compile_answers(args):
+    n = await database.compile_answers()
+    print(f"Варианты ответов пересчитаны для вопросов: {n}.")
+
+
+async def compact(args):
+    await database.vacuum()
+    print("База сжата (VACUUM).")
+
+
+COMMANDS = {
+    "rebuild-stats": (rebuild_stats, "пересобрать сводку статистики из answers_log"),
+    "archive": (archive, "перенести старые строки answers_log в архив"),
+    "compile-answers": (compile_answers, "заново нормализовать принятые ответы всех вопросов"),
+    "compact": (compact, "сжать файл базы (останавливает запись на время работы)"),
+}
+
+
+async def run(args):
+    await database.init()
+    try:
+        await COMMANDS[args.command][0](args)
+    finally:
+        await database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание базы MSR_BOT")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, (_, help_text) in COMMANDS.items():
+        sub.add_parser(name, help=help_text)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import json
+import re
+import unicodedata
+
+from config import ANSWER_MAX_TYPOS
+
+# варианты ответа в одном поле разделяются «|»: «Москва|Moscow»
+VARIANT_SEP = "|"
+# опечатка допускается на каждые столько символов ответа, чтобы «42» не
+# принимало «43»
+MIN_LEN_PER_TYPO = 5
+
+_PUNCT = re.compile(r"[\W_]+")
+
+
+# ---------- сравнение ответов ----------
+# Ответ и каждый принятый вариант приводятся к одной форме: NFKC, casefold,
+# ё → е, знаки препинания и лишние пробелы схлопываются. Варианты
+# нормализуются один раз при сохранении вопроса (questions.accepted),
+# поэтому проверка ответа — поиск в множестве, а опечатки (если включены)
+# считаются только при промахе.
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).casefold().replace("ё", "е")
+    folded = " ".join(_PUNCT.sub(" ", text).split())
+    # ответ из одних знаков («?», «+») не превращаем в пустую строку
+    return folded or " ".join(text.split())
+
+
+def compile_answer(answer: str) -> str:
+    # JSON-список нормализованных вариантов для questions.accepted
+    variants = []
+    for part in answer.split(VARIANT_SEP):
+        v = normalize(part)
+        if v and v not in variants:
+            variants.append(v)
+    return json.dumps(variants, ensure_ascii=False)
+
+
+def load_accepted(accepted: str | None, answer: str) -> frozenset[str]:
+    return frozenset(json.loads(accepted if accepted is not None else compile_answer(answer)))
+
+
+def within_distance(a: str, b: str, k: int) -> bool:
+    # Левенштейн не больше k: считается только полоса шириной 2k+1 вокруг
+    # диагонали, и как только вся строка полосы больше k — выходим
+    if abs(len(a) - len(b)) > k:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    inf = k + 1
+    prev = [j if j <= k else inf for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        lo, hi = max(1, i - k), min(len(b), i + k)
+        cur = [inf] * (len(b) + 1)
+        cur[0] = i if i <= k else inf
+        best = cur[0] if lo == 1 else inf
+        ca = a[i - 1]
+        for j in range(lo, hi + 1):
+            d = min(
+                prev[j - 1] + (ca != b[j - 1]),
+                prev[j] + 1,
+                cur[j - 1] + 1,
+            )
+            cur[j] = d if d <= k else inf
+            if cur[j] < best:
+                best = cur[j]
+        if best > k:
+            return False
+        prev = cur
+    return prev[len(b)] <= k
+
+
+def matches(given: str, accepted: frozenset[str], max_typos: int = ANSWER_MAX_TYPOS) -> bool:
+    text = normalize(given)
+    if text in accepted:
+        return True
+    if max_typos <= 0:
+        return False
+    return any(
+        within_distance(text, v, max_typos)
+        for v in accepted
+        if len(v) >= MIN_LEN_PER_TYPO * max_typos
+    )
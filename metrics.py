@@ -0,0 +1,157 @@
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.dispatcher.event.bases import CancelHandler, SkipHandler
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject
+
+# границы корзин гистограмм, секунды
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+# ---------- метрики ----------
+# Простые счётчики и гистограммы с одной меткой, без внешних зависимостей.
+# observe() — это bisect и пара сложений, так что их можно не выключать.
+# Наружу отдаются в текстовом формате Prometheus через serve().
+class Counter:
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.values: dict[str, float] = {}
+
+    def inc(self, label_value: str, n: float = 1):
+        self.values[label_value] = self.values.get(label_value, 0) + n
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for value, n in sorted(self.values.items()):
+            lines.append(f'{self.name}{{{self.label}="{value}"}} {n}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        # метка -> [счётчики корзин..., +Inf, сумма]
+        self.series: dict[str, list[float]] = {}
+
+    def observe(self, label_value: str, seconds: float):
+        s = self.series.get(label_value)
+        if s is None:
+            s = self.series[label_value] = [0] * (len(BUCKETS) + 2)
+        s[bisect_left(BUCKETS, seconds)] += 1
+        s[-1] += seconds
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, s in sorted(self.series.items()):
+            label = f'{self.label}="{value}"'
+            total = 0
+            for bound, n in zip(BUCKETS + ("+Inf",), s[:-1]):
+                total += n
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {total}')
+            lines.append(f"{self.name}_sum{{{label}}} {s[-1]}")
+            lines.append(f"{self.name}_count{{{label}}} {total}")
+        return lines
+
+
+class Gauge:
+    # значение считается в момент запроса /metrics
+    def __init__(self, name: str, help_text: str, read: Callable[[], float] = lambda: 0):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+
+HANDLER_SECONDS = Histogram("msr_handler_seconds", "Время работы обработчика", "handler")
+HANDLER_ERRORS = Counter("msr_handler_errors_total", "Исключения в обработчиках", "handler")
+DB_SECONDS = Histogram("msr_db_seconds", "Время запроса к базе", "query")
+API_SECONDS = Histogram("msr_api_seconds", "Время вызова Bot API", "method")
+API_ERRORS = Counter("msr_api_errors_total", "Ошибки вызовов Bot API", "method")
+THROTTLED = Counter("msr_throttled_total", "Отброшено обновлений от слишком частых пользователей", "event")
+DELETIONS_PENDING = Gauge("msr_deletions_pending", "Сообщений в очереди на удаление")
+LOG_QUEUE = Gauge("msr_log_queue", "Строк в очереди записи answers_log")
+OUTBOUND_WAITING = Gauge("msr_outbound_waiting", "Запросов к Telegram ждут своей очереди")
+STARTUP_SECONDS = Gauge("msr_startup_seconds", "От запуска процесса до первого обработанного обновления")
+
+REGISTRY = [
+    HANDLER_SECONDS,
+    HANDLER_ERRORS,
+    DB_SECONDS,
+    API_SECONDS,
+    API_ERRORS,
+    THROTTLED,
+    DELETIONS_PENDING,
+    LOG_QUEUE,
+    OUTBOUND_WAITING,
+    STARTUP_SECONDS,
+]
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+# ---------- middleware ----------
+class HandlerTimer(BaseMiddleware):
+    # inner middleware: срабатывает, когда обработчик уже выбран
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            result = await handler(event, data)
+        except (SkipHandler, CancelHandler):
+            # обработчик передал обновление дальше — это не ошибка и не его время
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            HANDLER_SECONDS.observe(name, time.perf_counter() - started)
+            raise
+        HANDLER_SECONDS.observe(name, time.perf_counter() - started)
+        return result
+
+
+class ApiTimer(BaseRequestMiddleware):
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            API_ERRORS.inc(name)
+            raise
+        finally:
+            API_SECONDS.observe(name, time.perf_counter() - started)
+
+
+# ---------- HTTP ----------
+# aiohttp.web импортируется только когда метрики включены
+async def _metrics(request):
+    from aiohttp import web
+
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def serve(host: str, port: int):
+    from aiohttp import web
+
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
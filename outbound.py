@@ -0,0 +1,181 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import Counter, OrderedDict
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    BanChatMember,
+    DeleteMessage,
+    DeleteMessages,
+    GetUpdates,
+    RestrictChatMember,
+    TelegramMethod,
+    UnbanChatMember,
+)
+
+from config import OUTBOUND_CHAT_BURST, OUTBOUND_CHAT_RATE, OUTBOUND_GLOBAL_RATE, OUTBOUND_MAX_RETRIES
+
+MAX_CHAT_BUCKETS = 10_000
+
+# чем меньше число, тем раньше запрос уходит в Telegram
+HIGH, NORMAL, LOW = 0, 1, 2
+HIGH_METHODS = (RestrictChatMember, BanChatMember, UnbanChatMember)
+LOW_METHODS = (DeleteMessage, DeleteMessages)
+
+log = logging.getLogger(__name__)
+
+
+def priority_of(method: TelegramMethod) -> int:
+    if isinstance(method, HIGH_METHODS):
+        return HIGH
+    if isinstance(method, LOW_METHODS):
+        return LOW
+    return NORMAL
+
+
+# ---------- token bucket с приоритетной очередью ----------
+# Пока токены есть и никто не ждёт, acquire() проходит сразу. Иначе запрос
+# встаёт в кучу по (приоритет, порядок поступления), и одна фоновая задача
+# выдаёт токены по мере пополнения — сначала более важным запросам.
+class PriorityBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._drain: asyncio.Task | None = None
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _take(self) -> float:
+        # 0 — токен взят, иначе сколько секунд подождать до следующего
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self, priority: int = NORMAL):
+        if not self._waiters and self._take() == 0:
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._drain is None:
+            self._drain = asyncio.create_task(self._run())
+        await fut
+
+    def pause(self, seconds: float):
+        # Telegram ответил 429: до конца retry_after токенов нет ни у кого
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    async def _run(self):
+        try:
+            while self._waiters:
+                delay = self._take()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                while self._waiters:
+                    _, _, fut = heapq.heappop(self._waiters)
+                    if not fut.done():
+                        fut.set_result(None)
+                        break
+                else:
+                    # все ждавшие отменились — токен не пропадает
+                    self.tokens += 1
+        finally:
+            self._drain = None
+
+
+# ---------- ограничитель исходящих запросов ----------
+# Middleware сессии бота: через него проходит каждый вызов Bot API.
+# Все запросы делят глобальный bucket, сообщения и удаления ещё и bucket
+# своего чата. Ограничения и баны идут вне очереди чата и первыми в
+# глобальной, поэтому во время рейда они не теряются за приветствиями.
+# На 429 запрос повторяется после retry_after, не больше max_retries раз.
+class OutboundLimiter(BaseRequestMiddleware):
+    def __init__(
+        self,
+        global_rate: float = OUTBOUND_GLOBAL_RATE,
+        chat_rate: float = OUTBOUND_CHAT_RATE,
+        chat_burst: int = OUTBOUND_CHAT_BURST,
+        max_retries: int = OUTBOUND_MAX_RETRIES,
+    ):
+        self.global_bucket = PriorityBucket(global_rate, int(global_rate) or 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats: OrderedDict[int | str, PriorityBucket] = OrderedDict()
+        self.calls: Counter[str] = Counter()
+        self.retries: Counter[str] = Counter()
+        self.failures: Counter[str] = Counter()
+        self.wait_seconds = 0.0
+
+    @property
+    def waiting(self) -> int:
+        return self.global_bucket.waiting + sum(b.waiting for b in self._chats.values())
+
+    def stats(self) -> dict:
+        return {
+            "calls": dict(self.calls),
+            "retries": dict(self.retries),
+            "failures": dict(self.failures),
+            "waiting": self.waiting,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
+
+    def _chat_bucket(self, chat_id: int | str) -> PriorityBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = PriorityBucket(self.chat_rate, self.chat_burst)
+            if len(self._chats) > MAX_CHAT_BUCKETS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+
+        name = type(method).__name__
+        priority = priority_of(method)
+        chat_id = getattr(method, "chat_id", None)
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None and priority != HIGH else None
+
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            if chat_bucket is not None:
+                await chat_bucket.acquire(priority)
+            await self.global_bucket.acquire(priority)
+            self.wait_seconds += time.monotonic() - started
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                (chat_bucket or self.global_bucket).pause(e.retry_after)
+                if attempt == self.max_retries:
+                    self.failures[name] += 1
+                    raise
+                self.retries[name] += 1
+                log.warning("429 на %s, повтор через %s с", name, e.retry_after)
+                continue
+            except Exception:
+                self.failures[name] += 1
+                raise
+            self.calls[name] += 1
+            return result
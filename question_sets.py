@@ -0,0 +1,107 @@
+import csv
+import io
+import json
+
+from matching import VARIANT_SEP
+
+MAX_QUESTIONS = 1000
+MAX_QUESTION_LEN = 1000
+MAX_ANSWER_LEN = 200
+MAX_ERRORS_SHOWN = 10
+HEADERS = ({"question", "answer"}, {"вопрос", "ответ"})
+
+
+# ---------- импорт и экспорт наборов вопросов ----------
+# Формат выбирается по расширению файла: .json — список объектов
+# {"question": ..., "answer": ...} (или пар [вопрос, ответ]; несколько
+# принятых ответов — списком или через «|»), иначе CSV
+# с колонками «вопрос, ответ» и необязательным заголовком. Файл проверяется
+# целиком до записи: при любой ошибке ValueError со списком строк, и в базу
+# не попадает ничего.
+def parse(data: bytes, filename: str = "") -> list[tuple[str, str]]:
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("Файл должен быть в кодировке UTF-8")
+    if filename.lower().endswith(".json"):
+        rows = _read_json(text)
+    else:
+        rows = _read_csv(text)
+    return _validate(rows)
+
+
+def _read_json(text: str) -> list[tuple[int, object, object]]:
+    try:
+        items = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Неверный JSON: {e}")
+    if not isinstance(items, list):
+        raise ValueError("JSON должен быть списком вопросов")
+    rows = []
+    for n, item in enumerate(items, 1):
+        if isinstance(item, dict):
+            answer = item.get("answer")
+            if isinstance(answer, list) and all(isinstance(v, str) for v in answer):
+                # несколько принятых ответов: ["Москва", "Moscow"]
+                answer = VARIANT_SEP.join(answer)
+            rows.append((n, item.get("question"), answer))
+        elif isinstance(item, list) and len(item) == 2:
+            rows.append((n, item[0], item[1]))
+        else:
+            rows.append((n, None, None))
+    return rows
+
+
+def _read_csv(text: str) -> list[tuple[int, object, object]]:
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t|")
+    except csv.Error:
+        dialect = csv.excel
+    rows = []
+    for n, row in enumerate(csv.reader(io.StringIO(text), dialect), 1):
+        if not any(cell.strip() for cell in row):
+            continue
+        if n == 1 and {cell.strip().lower() for cell in row} in HEADERS:
+            continue
+        rows.append((n, *row) if len(row) == 2 else (n, None, None))
+    return rows
+
+
+def _validate(rows: list[tuple[int, object, object]]) -> list[tuple[str, str]]:
+    errors = []
+    pairs = []
+    for n, q, a in rows:
+        if not isinstance(q, str) or not isinstance(a, str):
+            errors.append(f"{n}: нужны вопрос и ответ")
+            continue
+        q, a = q.strip(), a.strip()
+        if not q or not a:
+            errors.append(f"{n}: пустой вопрос или ответ")
+        elif len(q) > MAX_QUESTION_LEN or len(a) > MAX_ANSWER_LEN:
+            errors.append(f"{n}: вопрос длиннее {MAX_QUESTION_LEN} или ответ длиннее {MAX_ANSWER_LEN}")
+        else:
+            pairs.append((q, a))
+    if not rows:
+        errors.append("Файл пустой")
+    if len(rows) > MAX_QUESTIONS:
+        errors.append(f"Больше {MAX_QUESTIONS} вопросов")
+    if errors:
+        shown = errors[:MAX_ERRORS_SHOWN]
+        if len(errors) > MAX_ERRORS_SHOWN:
+            shown.append(f"… и ещё {len(errors) - MAX_ERRORS_SHOWN}")
+        raise ValueError("\n".join(shown))
+    return pairs
+
+
+def to_csv(pairs: list[tuple[str, str]]) -> bytes:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["question", "answer"])
+    writer.writerows(pairs)
+    # BOM, чтобы Excel сразу открыл кириллицу
+    return buf.getvalue().encode("utf-8-sig")
+
+
+def to_json(pairs: list[tuple[str, str]]) -> bytes:
+    items = [{"question": q, "answer": a} for q, a in pairs]
+    return json.dumps(items, ensure_ascii=False, indent=2).encode()
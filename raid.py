@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from config import RAID_JOINS_PER_MIN, RAID_WINDOW_SEC
+
+log = logging.getLogger(__name__)
+
+
+# ---------- режим рейда ----------
+# Считает вступления в каждом чате за последнюю минуту. Как только их
+# становится RAID_JOINS_PER_MIN, чат переходит в режим рейда: имена новых
+# участников копятся RAID_WINDOW_SEC секунд и объявляются одним сообщением
+# через on_flush. Режим выключается, когда темп падает ниже половины порога.
+class RaidMode:
+    def __init__(
+        self,
+        on_flush: Callable[[int, list[str]], Awaitable[None]],
+        threshold: int = RAID_JOINS_PER_MIN,
+        window_sec: float = RAID_WINDOW_SEC,
+    ):
+        self.on_flush = on_flush
+        self.threshold = max(2, threshold)
+        self.window_sec = window_sec
+        self._joins: dict[int, deque[float]] = {}
+        self._buffer: dict[int, list[str]] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        self.active: set[int] = set()
+
+    def _rate(self, chat_id: int, now: float) -> int:
+        joins = self._joins.get(chat_id)
+        if not joins:
+            return 0
+        while joins and joins[0] < now - 60:
+            joins.popleft()
+        return len(joins)
+
+    def joined(self, chat_id: int, name: str) -> bool:
+        # True — приветствие отложено и придёт общим сообщением
+        now = time.monotonic()
+        joins = self._joins.setdefault(chat_id, deque(maxlen=self.threshold))
+        joins.append(now)
+        rate = self._rate(chat_id, now)
+        if chat_id in self.active and chat_id not in self._tasks and rate < self.threshold // 2:
+            self._deactivate(chat_id)
+        if chat_id not in self.active:
+            if rate < self.threshold:
+                return False
+            self.active.add(chat_id)
+            log.warning("Рейд в чате %s: %d вступлений за минуту", chat_id, rate)
+        self._buffer.setdefault(chat_id, []).append(name)
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._flush_later(chat_id))
+        return True
+
+    async def _flush_later(self, chat_id: int):
+        try:
+            await asyncio.sleep(self.window_sec)
+        finally:
+            self._tasks.pop(chat_id, None)
+        await self._flush(chat_id)
+        if self._rate(chat_id, time.monotonic()) < self.threshold // 2:
+            self._deactivate(chat_id)
+
+    def _deactivate(self, chat_id: int):
+        self.active.discard(chat_id)
+        log.info("Рейд в чате %s закончился", chat_id)
+
+    async def _flush(self, chat_id: int):
+        names = self._buffer.pop(chat_id, None)
+        if not names:
+            return
+        try:
+            await self.on_flush(chat_id, names)
+        except Exception:
+            log.exception("Не удалось объявить %d вступивших в %s", len(names), chat_id)
+
+    async def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+        for chat_id in list(self._buffer):
+            await self._flush(chat_id)
@@ -0,0 +1,84 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+from collections import defaultdict
+
+import database
+from config import LOG_ARCHIVE_CHUNK, LOG_ARCHIVE_DIR, LOG_ARCHIVE_INTERVAL_SEC
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_FIELDS = ("id", "chat_id", "user_id", "username", "question", "given_answer", "is_correct", "ts")
+
+
+# ---------- архив answers_log ----------
+# Старые строки лога переезжают в сжатые файлы archive/<chat_id>/<ГГГГ-ММ>.jsonl.gz
+# и удаляются из базы пачками по LOG_ARCHIVE_CHUNK строк, каждая в своей
+# короткой транзакции, чтобы не держать блокировку записи. Файл пишется
+# раньше удаления: после сбоя пачка может попасть в архив дважды, поэтому
+# при чтении архива строки стоит различать по id.
+def _append(path: str, rows: list[tuple]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(dict(zip(ARCHIVE_FIELDS, row)), ensure_ascii=False) + "\n")
+
+
+async def archive_chat(chat_id: int, archive_dir: str = LOG_ARCHIVE_DIR, chunk: int = LOG_ARCHIVE_CHUNK):
+    days, max_rows = await database.get_log_retention(chat_id)
+    if not days and not max_rows:
+        return 0
+    moved = 0
+    while True:
+        rows = await database.get_archivable(chat_id, days, max_rows, chunk)
+        if not rows:
+            return moved
+        by_month: dict[str, list[tuple]] = defaultdict(list)
+        for row in rows:
+            by_month[str(row[7])[:7]].append(row)
+        for month, month_rows in by_month.items():
+            path = os.path.join(archive_dir, str(chat_id), f"{month}.jsonl.gz")
+            await asyncio.to_thread(_append, path, month_rows)
+        await database.delete_archived(rows)
+        moved += len(rows)
+        if len(rows) < chunk:
+            return moved
+        await asyncio.sleep(0)
+
+
+async def archive_all():
+    moved = 0
+    for chat_id in await database.get_logged_chats():
+        moved += await archive_chat(chat_id)
+    if moved:
+        await database.checkpoint()
+        log.info("В архив перенесено %d строк answers_log", moved)
+    return moved
+
+
+class LogArchiver:
+    def __init__(self, interval_sec: float = LOG_ARCHIVE_INTERVAL_SEC):
+        self.interval_sec = interval_sec
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await archive_all()
+            except Exception:
+                log.exception("Архивация answers_log не удалась")
+            await asyncio.sleep(self.interval_sec)
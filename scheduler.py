@@ -0,0 +1,106 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import defaultdict
+
+from aiogram import Bot
+
+import database
+from config import SHARD_COUNT, SHARD_INDEX
+
+log = logging.getLogger(__name__)
+
+# Bot API удаляет не больше 100 сообщений одного чата за вызов deleteMessages
+MAX_IDS_PER_CALL = 100
+
+
+# ---------- удаление сообщений по таймеру ----------
+# Один таймер на все отложенные удаления вместо задачи со sleep на каждое
+# сообщение. Задания лежат в куче по времени и дублируются в таблице
+# scheduled_deletions с номером воркера, поэтому после перезапуска load()
+# поднимает обратно задания своего воркера.
+# Всё, что созрело к моменту пробуждения (с запасом coalesce_sec), удаляется
+# пачкой, по одному вызову deleteMessages на чат.
+class DeletionScheduler:
+    def __init__(
+        self,
+        bot: Bot,
+        batch_size: int = 500,
+        coalesce_sec: float = 1.0,
+        shard: int = SHARD_INDEX,
+        shard_count: int = SHARD_COUNT,
+    ):
+        self.bot = bot
+        self.shard = shard
+        self.shard_count = shard_count
+        self.batch_size = batch_size
+        self.coalesce_sec = coalesce_sec
+        self._heap: list[tuple[float, int, int]] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def depth(self) -> int:
+        return len(self._heap)
+
+    async def load(self):
+        self._heap = list(await database.get_scheduled_deletions(self.shard, self.shard_count))
+        heapq.heapify(self._heap)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def schedule(self, chat_id: int, message_id: int, delay: float):
+        due_at = time.time() + delay
+        await database.add_scheduled_deletion(chat_id, message_id, due_at, self.shard)
+        heapq.heappush(self._heap, (due_at, chat_id, message_id))
+        if self._heap[0][0] == due_at:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._fire_due()
+
+    async def _fire_due(self):
+        # заодно забираем то, что созреет в ближайшие coalesce_sec секунд
+        now = time.time() + self.coalesce_sec
+        by_chat: dict[int, list[int]] = defaultdict(list)
+        done: list[tuple[int, int]] = []
+        while self._heap and self._heap[0][0] <= now and len(done) < self.batch_size:
+            _, chat_id, message_id = heapq.heappop(self._heap)
+            by_chat[chat_id].append(message_id)
+            done.append((chat_id, message_id))
+
+        for chat_id, ids in by_chat.items():
+            for i in range(0, len(ids), MAX_IDS_PER_CALL):
+                chunk = ids[i:i + MAX_IDS_PER_CALL]
+                try:
+                    if len(chunk) == 1:
+                        await self.bot.delete_message(chat_id, chunk[0])
+                    else:
+                        await self.bot.delete_messages(chat_id, chunk)
+                except Exception:
+                    # уже удалено руками или слишком старое — не повторяем
+                    pass
+        try:
+            await database.remove_scheduled_deletions(done)
+        except Exception:
+            log.exception("Не удалось очистить scheduled_deletions")
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import database
+from config import FSM_FLUSH_MS, FSM_TTL_SEC
+
+log = logging.getLogger(__name__)
+
+
+# ---------- хранилище FSM в базе ----------
+# Чтение и запись идут через словарь в памяти, поэтому обработчики не ждут
+# базу. Изменённые ключи раз в FSM_FLUSH_MS сохраняются в fsm_state одной
+# транзакцией, и состояние переживает перезапуск. Ключ, которого нет в
+# памяти, один раз читается из базы. Так другой процесс видит состояние,
+# если пользователь закреплён за одним воркером. Состояния, не менявшиеся
+# FSM_TTL_SEC секунд, удаляются и из памяти, и из базы.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, flush_ms: int = FSM_FLUSH_MS, ttl_sec: float = FSM_TTL_SEC):
+        self.flush_sec = flush_ms / 1000
+        self.ttl_sec = ttl_sec
+        # ключ -> [state, data, updated_at]
+        self._cache: dict[str, list] = {}
+        self._dirty: set[str] = set()
+        self._task: asyncio.Task | None = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = (key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny)
+        return ":".join("" if p is None else str(p) for p in parts)
+
+    async def _entry(self, key: StorageKey) -> list:
+        k = self._key(key)
+        entry = self._cache.get(k)
+        if entry is None:
+            row = await database.load_fsm(k)
+            if row and row[2] >= time.time() - self.ttl_sec:
+                entry = [row[0], json.loads(row[1] or "{}"), row[2]]
+            else:
+                entry = [None, {}, time.time()]
+            entry = self._cache.setdefault(k, entry)
+        return entry
+
+    async def _touch(self, key: StorageKey, index: int, value: Any):
+        entry = await self._entry(key)
+        entry[index] = value
+        entry[2] = time.time()
+        self._dirty.add(self._key(key))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._touch(key, 0, state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._entry(key))[0]
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        await self._touch(key, 1, data.copy())
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._entry(key))[1].copy()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        last_expire = time.time()
+        while True:
+            await asyncio.sleep(self.flush_sec)
+            try:
+                await self.flush()
+                if time.time() - last_expire >= min(self.ttl_sec, 3600):
+                    await self.expire()
+                    last_expire = time.time()
+            except Exception:
+                log.exception("Не удалось сохранить состояния FSM")
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        rows, deleted = [], []
+        for k in keys:
+            entry = self._cache.get(k)
+            if entry is None or (entry[0] is None and not entry[1]):
+                deleted.append(k)
+            else:
+                rows.append((k, entry[0], json.dumps(entry[1], ensure_ascii=False), entry[2]))
+        try:
+            await database.save_fsm(rows, deleted)
+        except Exception:
+            self._dirty |= keys
+            raise
+
+    async def expire(self):
+        before = time.time() - self.ttl_sec
+        for k in [k for k, entry in self._cache.items() if entry[2] < before and k not in self._dirty]:
+            del self._cache[k]
+        await database.expire_fsm(before)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
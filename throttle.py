@@ -0,0 +1,67 @@
+import logging
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.enums.chat_type import ChatType
+from aiogram.types import Message, TelegramObject
+
+import metrics
+from config import THROTTLE_BURST, THROTTLE_MAX_USERS, THROTTLE_RATE
+
+log = logging.getLogger(__name__)
+
+
+# ---------- ограничение частоты от одного пользователя ----------
+# Outer middleware на личные сообщения и нажатия кнопок: у каждого
+# пользователя свой token bucket (rate в секунду, запас burst). Если токенов
+# нет, обновление отбрасывается до фильтров, обработчиков и базы — флуд
+# ответами или кнопками стоит одну проверку в словаре. Словарь ограничен
+# max_users: дольше всех молчавшие вытесняются, а их bucket всё равно полон.
+class Throttle(BaseMiddleware):
+    def __init__(
+        self,
+        rate: float = THROTTLE_RATE,
+        burst: int = THROTTLE_BURST,
+        max_users: int = THROTTLE_MAX_USERS,
+    ):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_users = max_users
+        # user_id -> [токены, время пополнения]
+        self._buckets: OrderedDict[int, list[float]] = OrderedDict()
+        self.dropped: Counter[str] = Counter()
+
+    def allow(self, user_id: int) -> bool:
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [float(self.burst), now]
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or (isinstance(event, Message) and event.chat.type != ChatType.PRIVATE):
+            return await handler(event, data)
+        if self.allow(user.id):
+            return await handler(event, data)
+        kind = "message" if isinstance(event, Message) else "callback_query"
+        self.dropped[kind] += 1
+        metrics.THROTTLED.inc(kind)
+        log.debug("Слишком часто: %s от %s отброшено", kind, user.id)
+        return None
@@ -0,0 +1,148 @@
+import asyncio
+import hmac
+import logging
+import signal
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+from config import (
+    WEBHOOK_CONCURRENCY,
+    WEBHOOK_DRAIN_SEC,
+    WEBHOOK_HOST,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+)
+
+log = logging.getLogger(__name__)
+
+
+def shard_key(update: dict) -> int:
+    # Пользователь, к которому относится обновление: для вступления — сам
+    # вступивший, для сообщений и кнопок — отправитель. Обновления одного
+    # пользователя обрабатываются по порядку и попадают на один воркер.
+    for kind, value in update.items():
+        if not isinstance(value, dict):
+            continue
+        member = value.get("new_chat_member")
+        if member and member.get("user"):
+            return member["user"]["id"]
+        if value.get("from"):
+            return value["from"]["id"]
+        if value.get("chat"):
+            return value["chat"]["id"]
+    return update.get("update_id", 0)
+
+
+def route_key(update: dict) -> int:
+    # Воркер для обновления (workers.Router): вступление в группу уходит
+    # воркеру этой группы, чтобы режим рейда считал все её вступления и
+    # отправлял одно общее приветствие; остальное — по shard_key.
+    member = update.get("chat_member")
+    if member and member.get("chat"):
+        return member["chat"]["id"]
+    return shard_key(update)
+
+
+# ---------- приём обновлений по webhook ----------
+# Telegram сам присылает обновления POST-запросом, они сразу уходят в
+# dispatcher. Одновременно обрабатывается не больше concurrency обновлений:
+# когда лимит исчерпан, ответ на POST задерживается и Telegram притормаживает.
+# Обновления одного пользователя выполняются строго друг за другом.
+# При остановке новые запросы не принимаются, а начатые дорабатываются.
+class WebhookServer:
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        secret: str = WEBHOOK_SECRET,
+        concurrency: int = WEBHOOK_CONCURRENCY,
+        path: str = WEBHOOK_PATH,
+    ):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.path = path
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._tasks: set[asyncio.Task] = set()
+        self._tails: dict[int, asyncio.Task] = {}
+        self._closing = False
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.secret
+        ):
+            return web.Response(status=401)
+        if self._closing:
+            return web.Response(status=503)
+        try:
+            raw = await request.json()
+            update = Update.model_validate(raw, context={"bot": self.bot})
+        except ValueError:
+            return web.Response(status=400)
+
+        await self._slots.acquire()
+        key = shard_key(raw)
+        task = asyncio.create_task(self._process(update, self._tails.get(key)))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(lambda t: self._tails.get(key) is t and self._tails.pop(key))
+        return web.Response()
+
+    async def _process(self, update: Update, previous: asyncio.Task | None):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            log.exception("Ошибка при обработке обновления %s", update.update_id)
+        finally:
+            self._slots.release()
+
+    async def drain(self, timeout: float = WEBHOOK_DRAIN_SEC):
+        self._closing = True
+        if self._tasks:
+            log.info("Дожидаемся %d обновлений", len(self._tasks))
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+
+async def serve(dp: Dispatcher, bot: Bot, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+    # Без WEBHOOK_URL сервер только слушает порт и не регистрируется в
+    # Telegram — так его удобно проверять локально, присылая обновления curl'ом.
+    server = WebhookServer(dp, bot)
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("Webhook слушает %s:%s%s", host, port, server.path)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + server.path,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await server.drain()
+        await runner.cleanup()
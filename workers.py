@@ -0,0 +1,215 @@
+import asyncio
+import hmac
+import logging
+import os
+import secrets
+import signal
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from config import (
+    METRICS_PORT,
+    WEBHOOK_DRAIN_SEC,
+    WEBHOOK_HOST,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    WORKER_BASE_PORT,
+    WORKERS,
+)
+from webhook import route_key
+
+FORWARD_QUEUE_SIZE = 10_000
+FORWARD_MAX_DELAY = 5
+RESTART_MAX_DELAY = 60
+
+log = logging.getLogger(__name__)
+
+
+# ---------- маршрутизатор обновлений ----------
+# Принимает webhook от Telegram и раскладывает обновления по воркерам:
+# номер воркера — route_key(update) % N, поэтому сообщения и кнопки одного
+# пользователя идут в один процесс, а вступления в группу — в процесс
+# этой группы. В каждый воркер обновления уходят
+# строго по очереди, а внутри воркера WebhookServer сохраняет порядок для
+# каждого пользователя. Воркеры — обычные bot.py в режиме webhook на
+# локальных портах, база у них общая (SQLite в режиме WAL с busy_timeout).
+class Router:
+    def __init__(self, ports: list[int], secret: str, worker_secret: str):
+        self.ports = ports
+        self.secret = secret
+        self.worker_secret = worker_secret
+        self.queues = [asyncio.Queue(FORWARD_QUEUE_SIZE) for _ in ports]
+        self.forwarded = [0] * len(ports)
+        self._session: aiohttp.ClientSession | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._closing = False
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        return app
+
+    def start(self):
+        self._session = aiohttp.ClientSession()
+        self._tasks = [asyncio.create_task(self._forward(i)) for i in range(len(self.ports))]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.secret
+        ):
+            return web.Response(status=401)
+        if self._closing:
+            return web.Response(status=503)
+        body = await request.read()
+        try:
+            shard = route_key(await request.json()) % len(self.ports)
+        except (ValueError, AttributeError):
+            return web.Response(status=400)
+        await self.queues[shard].put(body)
+        return web.Response()
+
+    async def _forward(self, shard: int):
+        url = f"http://127.0.0.1:{self.ports[shard]}{WEBHOOK_PATH}"
+        headers = {
+            "Content-Type": "application/json",
+            "X-Telegram-Bot-Api-Secret-Token": self.worker_secret,
+        }
+        queue = self.queues[shard]
+        while True:
+            body = await queue.get()
+            delay = 0.1
+            while True:
+                try:
+                    async with self._session.post(url, data=body, headers=headers) as resp:
+                        if resp.status < 500:
+                            break
+                except aiohttp.ClientError:
+                    pass
+                # воркер ещё запускается, перегружен или перезапускается — ждём
+                # и повторяем, не обгоняя это обновление следующими
+                if delay == FORWARD_MAX_DELAY:
+                    log.warning("Воркер %d не отвечает, в очереди %d обновлений", shard, queue.qsize() + 1)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, FORWARD_MAX_DELAY)
+            self.forwarded[shard] += 1
+            queue.task_done()
+
+    async def drain(self, timeout: float = WEBHOOK_DRAIN_SEC):
+        self._closing = True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            log.warning("Не все обновления переданы воркерам")
+        for task in self._tasks:
+            task.cancel()
+        await self._session.close()
+
+
+async def start_worker(index: int, count: int, port: int, worker_secret: str):
+    env = {
+        **os.environ,
+        "TRANSPORT": "webhook",
+        "WEBHOOK_URL": "",
+        "WEBHOOK_HOST": "127.0.0.1",
+        "WEBHOOK_PORT": str(port),
+        "WEBHOOK_SECRET": worker_secret,
+        "SHARD_INDEX": str(index),
+        "SHARD_COUNT": str(count),
+        "METRICS_PORT": str(METRICS_PORT + index) if METRICS_PORT else "0",
+    }
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    return await asyncio.create_subprocess_exec(sys.executable, script, env=env)
+
+
+# ---------- присмотр за воркерами ----------
+# Упавший воркер перезапускается, а пока он поднимается, его обновления ждут
+# в очереди маршрутизатора. Если воркер падает сразу после запуска, пауза
+# перед перезапуском удваивается (до RESTART_MAX_DELAY секунд), чтобы не
+# крутить перезапуски вхолостую.
+class Supervisor:
+    def __init__(self, ports: list[int], worker_secret: str):
+        self.ports = ports
+        self.worker_secret = worker_secret
+        self.procs: list[asyncio.subprocess.Process | None] = [None] * len(ports)
+        self.restarts = [0] * len(ports)
+        self._tasks: list[asyncio.Task] = []
+        self._stopping = False
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._watch(i)) for i in range(len(self.ports))]
+
+    async def _watch(self, index: int):
+        delay = 1
+        while True:
+            proc = self.procs[index] = await start_worker(
+                index, len(self.ports), self.ports[index], self.worker_secret
+            )
+            started = time.monotonic()
+            code = await proc.wait()
+            if self._stopping:
+                return
+            if time.monotonic() - started > RESTART_MAX_DELAY:
+                delay = 1
+            self.restarts[index] += 1
+            log.error("Воркер %d завершился с кодом %s, перезапуск через %d с", index, code, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RESTART_MAX_DELAY)
+
+    async def stop(self):
+        self._stopping = True
+        procs = [proc for proc in self.procs if proc is not None]
+        for proc in procs:
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGTERM)
+        await asyncio.gather(*(proc.wait() for proc in procs))
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def main(workers: int = WORKERS):
+    logging.basicConfig(level=logging.INFO)
+    worker_secret = secrets.token_urlsafe(32)
+    ports = [WORKER_BASE_PORT + i for i in range(workers)]
+    supervisor = Supervisor(ports, worker_secret)
+    supervisor.start()
+
+    router = Router(ports, WEBHOOK_SECRET, worker_secret)
+    router.start()
+    runner = web.AppRunner(router.app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    log.info("Маршрутизатор слушает %s:%s%s, воркеров: %d", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, workers)
+
+    if WEBHOOK_URL:
+        import bot
+
+        await bot.bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=bot.dp.resolve_used_update_types(),
+        )
+        await bot.bot.session.close()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await router.drain()
+        await runner.cleanup()
+        await supervisor.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())